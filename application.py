@@ -1,17 +1,21 @@
-from flask import Flask, render_template, request, Response, redirect, url_for, g
+from flask import Flask, render_template, request, Response, redirect, url_for, g, jsonify
 from flask_bootstrap import Bootstrap
 import logging
 from datetime import datetime
 import platform
+import json
 import os
 
-from vision import VideoStreaming, ObjectDetection, reset_settings
+from vision import (VideoStreaming, ObjectDetection, BatchedInference, MotionGate,
+                    Tracker, reset_settings)
 from hearing import MicrophoneStreaming
 from speech import SpeechProduction
 from state import State
-from gpt import GPTConnection
+from gpt import GPTConnection, ResponseWorker, make_backend
 from arduino import Arduino
 from mindmup import MindMup
+from events import EventBus
+import startup
 
 app = Flask(__name__)
 log = app.logger
@@ -21,17 +25,82 @@ logging.basicConfig(level=logging.INFO)
 
 # Configure setup
 TITLE = "VUmanoid"
+# Start serving right away and load the heavy models in the background;
+# see /status for what is ready
+LAZY_STARTUP = True
+# Offline replay: a video file or image directory instead of the camera and
+# WAV files instead of the microphone, played at real-time speed or as fast
+# as possible (e.g. to benchmark the whole loop on a headless machine)
+REPLAY_VIDEO = os.getenv("VUMANOID_REPLAY_VIDEO")
+REPLAY_AUDIO = os.getenv("VUMANOID_REPLAY_AUDIO")
+REPLAY_REALTIME = os.getenv("VUMANOID_REPLAY_REALTIME", "1") != "0"
 VIDEO_PREVIEW = USE_SPEECH = USE_MIC = USE_ARDUINO = True
 USE_SPEECH = False
+# Run detection in a background worker at most DETECT_FPS times per second,
+# so the preview keeps running at camera rate
+DETECT_ASYNC, DETECT_FPS = True, None
+if REPLAY_VIDEO and not REPLAY_REALTIME:
+    # A fast replay detects in every frame it shows, so that its SEE inputs
+    # don't depend on timing
+    DETECT_ASYNC = False
+# Only run detection when more than this fraction of the (downscaled) frame
+# changed; set to None to run it on every frame
+MOTION_THRESHOLD = 0.01
+# Run full detection every TRACK_EVERY frames and track boxes in between;
+# set to None to detect on every frame
+TRACK_EVERY = 10
+# Camera indices; with more than one camera, their frames are detected in
+# one batch and each camera gets its own /video_feed/<n>
+CAMERAS = [REPLAY_VIDEO] if REPLAY_VIDEO else [0]
+# Stream settings: frames per second, JPEG quality (0-100) and either a
+# scale of the camera frames or a fixed (width, height)
+STREAM = dict(fps=30, jpeg_quality=80, scale=0.5, resolution=None)
 
-AUDIO = MicrophoneStreaming(ok_speech_threshold=0.4, enabled=USE_MIC, model='tiny')
-SPEECH = SpeechProduction(audio=AUDIO, rate=128, enabled=USE_SPEECH)
+# Streaming transcription: decode partial hypotheses while someone speaks and
+# send the final one after a pause, instead of waiting for whole phrases
+AUDIO_STREAMING = False
+# Whisper decoding; see `python benchmark.py whisper` to compare settings
+WHISPER_SETTINGS = dict(beam_size=None, temperature_fallback=True,
+                        condition_on_previous_text=True, threads=None, quantize=False)
+AUDIO = MicrophoneStreaming(ok_speech_threshold=0.4, enabled=USE_MIC, model='tiny',
+                            lazy=LAZY_STARTUP, streaming=AUDIO_STREAMING,
+                            source=REPLAY_AUDIO, realtime=REPLAY_REALTIME,
+                            **WHISPER_SETTINGS)
+SPEECH = SpeechProduction(audio=AUDIO, rate=128, enabled=USE_SPEECH, lazy=LAZY_STARTUP)
+# Face detection only inside person boxes when YOLO found any. Frames are
+# already scaled down by STREAM['scale'], so the cascade gets them as they are
+# (min_size is in those pixels); see `python benchmark.py faces` for others
+FACE_SETTINGS = dict(scale=1.0, scale_factor=1.1, min_size=(40, 40), in_persons=True)
+# DNN input size (320, 416 or 608) and OpenCV backend/target, e.g. 'openvino'
+# on 'cpu'; see `python benchmark.py dnn` to compare them
+DNN_SETTINGS = dict(input_size=416, backend='default', target='cpu')
 OBJECT_DETECTION = ObjectDetection(dnn_model = 'yolov3-tiny', detect_faces = True, 
-                                   detect_objects = True)
-VIDEO = VideoStreaming(OBJECT_DETECTION, cam_index=0, preview=VIDEO_PREVIEW)
+                                   detect_objects = True, face_settings=FACE_SETTINGS,
+                                   lazy=LAZY_STARTUP, **DNN_SETTINGS)
+DETECTOR = OBJECT_DETECTION
+if len(CAMERAS) > 1:
+    DETECTOR = BatchedInference(OBJECT_DETECTION, batch_size=len(CAMERAS))
+VIDEOS = [
+    VideoStreaming(DETECTOR, cam_index=cam, preview=VIDEO_PREVIEW,
+                   detect_async=DETECT_ASYNC, detect_fps=DETECT_FPS,
+                   motion_gate=MotionGate(threshold=MOTION_THRESHOLD) if MOTION_THRESHOLD else None,
+                   tracker=Tracker(detect_every=TRACK_EVERY) if TRACK_EVERY else None,
+                   name=(n if len(CAMERAS) > 1 else None), realtime=REPLAY_REALTIME,
+                   **STREAM)
+    for n, cam in enumerate(CAMERAS)
+]
+VIDEO = VIDEOS[0]
+if LAZY_STARTUP:
+    startup.load('vision', OBJECT_DETECTION.load)
+    startup.load('hearing', AUDIO.load)
+    startup.load('speech', SPEECH.load)
 MINDMAP = MindMup('mindmup/tutorial.mup')
 
 STATE = State(f"state-{datetime.now():%Y%m%d-%H%M%S}.txt")
+# Inputs and outputs go through an in-process event bus, so producers such as
+# the camera never wait for the state log or the language model
+BUS = EventBus(maxsize=100)
+State.bus = BUS
 STATE.register_action('SAY', lambda content: SPEECH.speak(content))
 
 persona = """You are a humanoid robot with sensors and actuators. You recieve inputs and respond with outputs that both start with a capitalized keyword. For now, the input keywords are HEAR (for audio speech transcription), SEE (for object detection, encoded as emojis); the output keywords are WAIT (no content), LED (LED 1 for on, LED 0 for off), and SAY (for speech production). Your task is to answer questions about the things you see, but only when you hear a question. Also turn the LED on or off when asked to. For example, if you get:
@@ -42,12 +111,27 @@ If you then get:
 you respond: SAY A bicycle has two wheels.
 """
 
-GPT = GPTConnection(STATE, persona, MINDMAP.parse(), os.getenv("OPENAI_API_KEY"))
-PROCESS_INPUT = GPT.respond
+# Token budget of a request (system prompt, summary of older turns, recent
+# turns and room for the reply) and seconds to wait for a reply
+GPT_SETTINGS = dict(context_budget=3000, reply_tokens=256, request_timeout=30)
+# Completion backend: 'openai', or a local stand-in to run without network:
+# 'rules' (answers from a few rules) or 'replay:<state log>,...' (replies
+# recorded in earlier sessions)
+GPT_BACKEND = os.getenv("VUMANOID_GPT_BACKEND", "openai")
+# Replies are cached by the system prompt, the input and the key_messages
+# messages before it; set to None to always ask the backend
+GPT_CACHE = dict(maxsize=256, ttl=600, key_messages=3)
+GPT = GPTConnection(STATE, persona, MINDMAP.parse(), os.getenv("OPENAI_API_KEY"),
+                    backend=make_backend(GPT_BACKEND, GPT_CACHE), **GPT_SETTINGS)
+# Inputs are answered one at a time in the background, merging SEE inputs that
+# arrive in the meantime and answering HEAR inputs first
+RESPONDER = ResponseWorker(GPT)
+PROCESS_INPUT = RESPONDER.submit
 
 # To test the arduino, find the right serial port and enable it
 USE_ARDUINO = True
-ARDUINO = Arduino(serial_port='/dev/cu.usbmodem142301', enabled = USE_ARDUINO,
+# The baud rate must match BAUD_RATE in pyduino_sketch.ino
+ARDUINO = Arduino(serial_port='/dev/cu.usbmodem142301', baud_rate=115200, enabled = USE_ARDUINO,
                   pin_modes={13:'O'})
 if USE_ARDUINO:
     # This registers an action to control the LED with "LED 1" and "LED 0"
@@ -56,37 +140,133 @@ if USE_ARDUINO:
 # Register web interface
 @app.route("/")
 def home():
+    startup.mark('first page')
     return render_template(
         "index.html", 
         title=TITLE, preview=VIDEO._preview, platform=platform.system().lower(),
+        cameras=range(len(VIDEOS)),
         secret = str(GPT.get_key()))
 
 @app.route("/video_feed")
-def video_feed():
-    return Response(VIDEO.show(), mimetype="multipart/x-mixed-replace; boundary=frame")
+@app.route("/video_feed/<int:cam>")
+def video_feed(cam=0):
+    if cam >= len(VIDEOS):
+        return Response(status = 404)
+    return Response(VIDEOS[cam].show(), mimetype="multipart/x-mixed-replace; boundary=frame")
+
+@app.route("/video_stats")
+def video_stats():
+    stats = [video.stats() for video in VIDEOS]
+    if isinstance(DETECTOR, BatchedInference):
+        return jsonify(cameras=stats, **DETECTOR.stats())
+    return jsonify(stats[0])
 
 @app.route("/audio_feed")
 def audio_feed():
     return Response(AUDIO.show(), mimetype="multipart/x-mixed-replace; boundary=frame")
 
+@app.route("/audio_level")
+def audio_level():
+    # Server-Sent Events with the meter status, drawn by the page itself; a
+    # keepalive comment while it doesn't change notices closed connections
+    events = (": keepalive\n\n" if status is None else f"data: {json.dumps(status)}\n\n"
+              for status in AUDIO.levels())
+    return Response(events, mimetype="text/event-stream")
+
+@app.route("/audio_stats")
+def audio_stats():
+    return jsonify(AUDIO.stats())
+
 @app.route("/arduino_feed")
 def arduino_feed():
     return Response(ARDUINO.show(), mimetype="multipart/x-mixed-replace; boundary=frame")
 
+@app.route("/arduino_state")
+def arduino_state():
+    return jsonify(ARDUINO.board.latest()[1])
+
+@app.route("/arduino_stats")
+def arduino_stats():
+    return jsonify(ARDUINO.stats())
+
+def handle_event(event):
+    message = event.message
+    log.info(message)
+    seq = STATE.log(message)
+
+    if message[0] == '<':
+        keyword, content = message[1:].split(' ', 1)
+        PROCESS_INPUT(keyword, content, seq)
+
+BUS.subscribe(handle_event)
+BUS.start()
+
+if REPLAY_VIDEO:
+    # Nobody may be watching, so detect and start capturing right away; the
+    # capture thread waits for the model before reading the first frame
+    VIDEO.detect = True
+    VIDEO.start()
+
 @app.route("/state", methods=["POST", "GET"])
 def get_or_set_state():
     if request.method == 'POST':
+        # For external clients; everything else publishes on the bus directly
         message = request.get_data().decode('utf-8')
-        log.info(message)
-        STATE.log(message)
-
-        if message[0] == '<':
-            keyword, content = message[1:].split(' ', 1)
-            PROCESS_INPUT(keyword, content)
-
+        if message:
+            BUS.publish(message)
         return Response(status = 200) 
     elif request.method == 'GET':
-        return STATE.read()
+        # ?since=<seq> for only the newer messages, ?last=<n> for the last n;
+        # the X-State-Seq header has the seq to continue from
+        since = request.args.get('since', 0, type=int)
+        last = request.args.get('last', None, type=int)
+        seq = STATE.seq
+        if since > seq:
+            # A seq of an earlier run of the server: send everything
+            since = 0
+        return Response(STATE.read(since, last, seq), mimetype='text/plain',
+                        headers={'X-State-Seq': str(seq)})
+
+@app.route("/state/stream")
+def state_stream():
+    # Server-Sent Events with every new state message; a reconnecting browser
+    # resumes after the Last-Event-ID it sends
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+
+    def events(since):
+        if since > STATE.seq:
+            # A Last-Event-ID of an earlier run of the server: start over
+            since = 0
+        while True:
+            seq = STATE.wait(since, timeout=15)
+            if seq <= since:
+                yield ": keepalive\n\n"
+                continue
+            first = max(since, STATE.offset) + 1 # older messages were cleared
+            for i, line in enumerate(STATE.lines(since, until=seq), first):
+                yield f"id: {i}\ndata: {line}\n\n"
+            since = seq
+
+    return Response(events(since), mimetype="text/event-stream")
+
+@app.route("/event_stats")
+def event_stats():
+    return jsonify(BUS.stats())
+
+@app.route("/gpt_stats")
+def gpt_stats():
+    return jsonify(RESPONDER.stats())
+
+@app.route("/gpt_cancel", methods=["POST"])
+def gpt_cancel():
+    RESPONDER.cancel()
+    return Response(status = 200)
+
+@app.route("/status")
+def status():
+    return jsonify(startup.status())
 
 @app.route("/secret_set", methods=["POST"])
 def secret_set():
@@ -101,6 +281,26 @@ def secret_set():
 @app.route("/camera_set", methods=["POST"])
 def camera_set():
     data = request.get_json(force=True)
+    # Without a camera index, settings apply to all cameras
+    videos = VIDEOS
+    if 'cam' in data:
+        try:
+            cam = int(data['cam'])
+        except (TypeError, ValueError):
+            cam = None
+        if cam in range(len(VIDEOS)):
+            videos = [VIDEOS[cam]]
+        else:
+            response = jsonify(error=f"No camera {data['cam']!r}, there are {len(VIDEOS)}")
+            response.status_code = 400
+            return response
+    for video in videos:
+        response = set_camera(video, data)
+        if response.status_code != 200:
+            break
+    return response
+
+def set_camera(VIDEO, data):
     if 'cam_preview' in data:
         VIDEO.preview = data['cam_preview']
         log.info(f"cam_preview: {VIDEO.preview}")
@@ -113,6 +313,18 @@ def camera_set():
         VIDEO.detect = data['cam_detect']
         log.info(f"cam_flip: {VIDEO.detect}")
         return Response(status = 200) 
+    elif 'cam_gate' in data and VIDEO.gate:
+        VIDEO.gate.enabled = bool(data['cam_gate'])
+        log.info(f"cam_gate: {VIDEO.gate.enabled}")
+        return Response(status = 200)
+    elif 'cam_fps' in data:
+        VIDEO.fps = float(data['cam_fps'])
+        log.info(f"cam_fps: {VIDEO.fps}")
+        return Response(status = 200)
+    elif 'cam_quality' in data:
+        VIDEO.jpeg_quality = int(data['cam_quality'])
+        log.info(f"cam_quality: {VIDEO.jpeg_quality}")
+        return Response(status = 200)
     elif 'cam_exposure' in data:
         VIDEO.exposure = data['cam_exposure']
         log.info(f"cam_exposure: {VIDEO.exposure}")
@@ -122,9 +334,17 @@ def camera_set():
         log.info(f"cam_contrast: {VIDEO.contrast}")
         return Response(status = 200)
     elif 'cam_reset' in data:
-        reset_settings()
+        reset_settings(VIDEO.VIDEO)
         log.info(f"cam_reset")
         return Response(status = 200) 
+    elif 'cam_gate' in data:
+        error = f"Camera {VIDEO.name} has no change gate"
+    else:
+        error = f"No known camera setting in {sorted(data)}"
+    log.warning(error)
+    response = jsonify(error=error)
+    response.status_code = 400
+    return response
 
 
 if __name__ == "__main__":
@@ -1,9 +1,17 @@
 from PIL import Image, ImageDraw, ImageFont
 import serial
+import asyncio
 import io
+import queue
+import threading
 import time
 import logging
 import serial.tools.list_ports
+from collections import deque
+from concurrent.futures import Future
+
+from arduino_emulator import EmulatedSerial
+from broadcast import Broadcast
 
 log = logging.getLogger(__name__)
 BOARD_IMG = Image.open("static/arduino.png").convert("RGBA")
@@ -21,28 +29,212 @@ print(ports)
 class Arduino():
     """
     Models an Arduino connection
+
+    A worker thread owns the serial port: commands are queued and written in
+    order, and several reads can be in flight at once. Replies are matched
+    to their reads by header (e.g. D13 or A4). Every method returns right
+    away with a Future; digital_read and analog_read wait for it, the
+    *_nowait variants return it and the *_async variants can be awaited.
+
+    The last value read from each pin, by any read, batch read or
+    subscription, is kept in the values table (e.g. values['A4']).
     """
 
-    def __init__(self, enabled = True, serial_port=None, baud_rate=9600,
-            read_timeout=5, pin_modes = ()):
+    def __init__(self, enabled = True, serial_port=None, baud_rate=115200,
+            read_timeout=5, pin_modes = (), max_in_flight=8):
         """
-        Initializes the serial connection to the Arduino board
+        Initializes the serial connection to the Arduino board, or to an
+        emulated one with serial_port='emulator'
         """
         self.pin_modes = {}
+        self.pin_values = {} # pin -> value last written
+        # Pin modes and written values, published when they change, and the
+        # board image of the last state
+        self.board = Broadcast({'modes': {}, 'values': {}})
+        self._frame = (None, None) # (board seq, multipart PNG frame)
+        self._render_lock = threading.Lock()
+        self.values = {} # e.g. 'D13' or 'A4' -> (value, time read)
+        self.read_timeout = read_timeout
+        self.commands = queue.Queue() # (command, header, future)
+        self.pending = {} # reply header -> deque of (deadline, future)
+        self.pending_lock = threading.Lock()
+        # The board only buffers 64 bytes, so don't send too many reads at once
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.written = 0
+        self.replies = 0
+        self.timeouts = 0
+        self.enabled = False
+        self._threads = []
         if enabled:
             try:
-                self.conn = serial.Serial(serial_port, baud_rate)
-                self.conn.timeout = read_timeout # Timeout for readline()
-                time.sleep(2)
+                # Short reads, so the reader notices replies that never come
+                if serial_port == 'emulator':
+                    self.conn = EmulatedSerial(serial_port, baud_rate, timeout=0.1)
+                else:
+                    self.conn = serial.Serial(serial_port, baud_rate, timeout=0.1)
+                    time.sleep(2)
+                self.enabled = True
+                self._threads = [threading.Thread(target=self.write_forever, daemon=True),
+                                 threading.Thread(target=self.read_forever, daemon=True)]
+                for thread in self._threads:
+                    thread.start()
                 if pin_modes:
                     for pin, mode in pin_modes.items():
                         self.set_pin_mode(pin, mode)
 
             except Exception as e:
-                enabled = False
                 log.error(e)
-            
-            
+
+    def submit(self, command, header=None):
+        """
+        Queues a command and returns a Future of its reply value if it has a
+        reply header, or of None once it is written
+        """
+        future = Future()
+        if not self.enabled:
+            log.debug(f"Not connected, dropping {command}")
+            future.set_result(None)
+            return future
+        self.commands.put((command.encode() + b'\n', header, future))
+        return future
+
+    def close(self):
+        """Stops the serial worker and closes the port"""
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.commands.put(None) # wakes the writer
+        for thread in self._threads:
+            thread.join(timeout=1)
+        self.conn.close()
+
+    def write_forever(self):
+        while self.enabled:
+            item = self.commands.get()
+            if item is None:
+                break
+            command, header, future = item
+            # Skips commands cancelled while queued; a running one can't be
+            if not future.set_running_or_notify_cancel():
+                continue
+            if header is not None:
+                self.in_flight.acquire()
+                # The slot is free again once the read finishes in any way
+                future.add_done_callback(lambda _: self.in_flight.release())
+                # Registered before writing, so a fast reply finds it
+                with self.pending_lock:
+                    self.pending.setdefault(header, deque()).append(
+                        (time.time() + self.read_timeout, future))
+            try:
+                self.conn.write(command)
+                log.debug(f"Writing {command}")
+                self.written += 1
+            except Exception as e:
+                log.error(e)
+                if header is not None:
+                    # Fail this read, not the oldest one with its header
+                    with self.pending_lock:
+                        waiting = self.pending[header]
+                        for entry in waiting:
+                            if entry[1] is future:
+                                waiting.remove(entry)
+                                break
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    future.set_exception(e)
+                continue
+            if header is None:
+                future.set_result(None)
+
+    def read_forever(self):
+        buffer = b''
+        while self.enabled:
+            try:
+                # Whatever arrived, or wait up to the port timeout for a byte
+                buffer += self.conn.read(self.conn.in_waiting or 1)
+            except Exception as e:
+                log.error(e)
+                time.sleep(1)
+                continue
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                line_received = line.decode(errors='replace').strip()
+                if line_received:
+                    log.debug(f"Read {line_received}")
+                    self.handle_reply(line_received)
+            self.expire()
+
+    def handle_reply(self, line_received):
+        # e.g. D13:1, or BD13:1,A4:512 for a batch read and SD13:1,A4:512
+        # for a subscription
+        batch = line_received[0] in 'BS'
+        values = {}
+        try:
+            for item in (line_received[1:] if batch else line_received).split(','):
+                header, value = item.split(':')
+                values[header] = int(value)
+        except ValueError:
+            log.warning(f"Unexpected reply {line_received}")
+            return
+        self.replies += 1
+        now = time.time()
+        for header, value in values.items():
+            self.values[header] = (value, now)
+        if batch:
+            if line_received[0] == 'B' and not self.resolve('B', values):
+                log.warning(f"Unexpected reply {line_received}")
+        elif not self.resolve(header, value):
+            log.warning(f"Unexpected reply {line_received}")
+
+    def resolve(self, header, value):
+        """
+        Resolves the oldest read waiting for a reply with this header. The
+        board replies in order, so if that read timed out already, this is
+        its late reply and it is dropped.
+        """
+        with self.pending_lock:
+            waiting = self.pending.get(header)
+            if not waiting:
+                return False
+            _, future = waiting.popleft()
+            if future.done():
+                log.warning(f"Dropped late reply {header}:{value}")
+                return True
+            # Under the lock, so expire() can't fail it at the same time
+            future.set_result(value)
+        return True
+
+    def expire(self):
+        """
+        Fails reads without a reply after read_timeout. They stay in line
+        for another read_timeout, so that a late reply is not taken for the
+        reply to the next read.
+        """
+        now = time.time()
+        with self.pending_lock:
+            for header, waiting in self.pending.items():
+                for deadline, future in waiting:
+                    if deadline >= now:
+                        break
+                    if not future.done():
+                        future.set_exception(TimeoutError(f"No reply for {header}"))
+                        self.timeouts += 1
+                # Give up on late replies that never came
+                while waiting and waiting[0][0] + self.read_timeout < now:
+                    waiting.popleft()
+
+    def stats(self):
+        with self.pending_lock:
+            waiting = sum(len(w) for w in self.pending.values())
+        return {
+            'queued': self.commands.qsize(),
+            'waiting': waiting,
+            'written': self.written,
+            'replies': self.replies,
+            'timeouts': self.timeouts,
+        }
+
     def set_pin_mode(self, pin_number, mode):
         """
         Performs a pinMode() operation on pin_number
@@ -51,25 +243,24 @@ class Arduino():
         - O for OUTPUT
         - P for INPUT_PULLUP
         """
-        command = (''.join(('M',mode,str(pin_number)))).encode()
-        log.info(f"Writing {command}")
-        self.conn.write(command)
         self.pin_modes[pin_number] = mode
+        self.update_board()
+        return self.submit(''.join(('M',mode,str(pin_number))))
 
-    def digital_read(self, pin_number):
+    def digital_read_nowait(self, pin_number):
         """
-        Performs a digital read on pin_number and returns the value (1 or 0)
+        Performs a digital read on pin_number and returns a Future of the
+        value (1 or 0)
         Internally sends b'RD{pin_number}' over the serial connection
         """
-        command = (''.join(('RD', str(pin_number)))).encode()
-        self.conn.write(command)
-        log.info(f"Writing {command}")
-        line_received = self.conn.readline().decode().strip()
-        log.info(f"Read {line_received}")
-        header, value = line_received.split(':') # e.g. D13:1
-        if header == ('D'+ str(pin_number)):
-            # If header matches
-            return int(value)
+        return self.submit(''.join(('RD', str(pin_number))), 'D' + str(pin_number))
+
+    def digital_read(self, pin_number):
+        """Performs a digital read on pin_number and returns the value (1 or 0)"""
+        return self.digital_read_nowait(pin_number).result()
+
+    async def digital_read_async(self, pin_number):
+        return await asyncio.wrap_future(self.digital_read_nowait(pin_number))
 
     def digital_write(self, pin_number, digital_value):
         """
@@ -77,25 +268,60 @@ class Arduino():
         Internally sends b'WD{pin_number}:{digital_value}' over the serial
         connection
         """
-        command = (''.join(('WD', str(pin_number), ':',
-            str(digital_value)))).encode()
-        log.info(f"Writing {command}")
-        self.conn.write(command) 
-     
-    def analog_read(self, pin_number):
+        self.pin_values[pin_number] = int(digital_value)
+        self.update_board()
+        return self.submit(''.join(('WD', str(pin_number), ':', str(digital_value))))
+
+    def analog_read_nowait(self, pin_number):
         """
-        Performs an analog read on pin_number and returns the value (0 to 1023)
+        Performs an analog read on pin_number and returns a Future of the
+        value (0 to 1023)
         Internally sends b'RA{pin_number}' over the serial connection
         """
-        command = (''.join(('RA', str(pin_number)))).encode()
-        self.conn.write(command) 
-        log.info(f"Writing {command}")
-        line_received = self.conn.readline().decode().strip()
-        log.info(f"Read {line_received}")
-        header, value = line_received.split(':') # e.g. A4:1
-        if header == ('A'+ str(pin_number)):
-            # If header matches
-            return int(value)
+        return self.submit(''.join(('RA', str(pin_number))), 'A' + str(pin_number))
+
+    def analog_read(self, pin_number):
+        """Performs an analog read on pin_number and returns the value (0 to 1023)"""
+        return self.analog_read_nowait(pin_number).result()
+
+    async def analog_read_async(self, pin_number):
+        return await asyncio.wrap_future(self.analog_read_nowait(pin_number))
+
+    def read_pins_nowait(self, pins):
+        """
+        Reads several pins at once, e.g. ['D12', 'A0'], and returns a Future
+        of a dict of their values
+        Internally sends b'BD12,A0' over the serial connection
+        """
+        return self.submit('B' + ','.join(pins), 'B')
+
+    def read_pins(self, pins):
+        """Reads several pins at once, e.g. ['D12', 'A0'], and returns a dict of their values"""
+        return self.read_pins_nowait(pins).result()
+
+    async def read_pins_async(self, pins):
+        return await asyncio.wrap_future(self.read_pins_nowait(pins))
+
+    def subscribe(self, pins, interval=100):
+        """
+        Makes the board send the values of pins, e.g. ['D12', 'A0'], every
+        interval ms into the values table
+        Internally sends b'S{interval},D12,A0' over the serial connection
+        """
+        return self.submit(','.join([f'S{int(interval)}'] + list(pins)))
+
+    def unsubscribe(self):
+        return self.submit('S0')
+
+    def latest(self, pin, max_age=None):
+        """
+        Last value read from pin, e.g. 'A0', or None if it was never read or
+        is older than max_age seconds
+        """
+        value, read_time = self.values.get(pin, (None, 0))
+        if max_age is not None and time.time() - read_time > max_age:
+            return None
+        return value
 
     def analog_write(self, pin_number, analog_value):
         """
@@ -103,35 +329,56 @@ class Arduino():
         Internally sends b'WA{pin_number}:{analog_value}' over the serial
         connection
         """
-        command = (''.join(('WA', str(pin_number), ':',
-            str(analog_value)))).encode()
-        log.info(f"Writing {command}")
-        self.conn.write(command) 
+        self.pin_values[pin_number] = int(analog_value)
+        self.update_board()
+        return self.submit(''.join(('WA', str(pin_number), ':', str(analog_value))))
+
+    def update_board(self):
+        """Publishes the pin modes and written values if they changed"""
+        state = {'modes': dict(self.pin_modes), 'values': dict(self.pin_values)}
+        if state != self.board.latest()[1]:
+            self.board.publish(state)
+
+    def frame(self, seq, state):
+        """Board image of a state as a multipart PNG frame, rendered once per state"""
+        with self._render_lock:
+            if self._frame[0] != seq:
+                im = BOARD_IMG.copy()
+                draw = ImageDraw.Draw(im)
+                font = ImageFont.load_default()
+
+                for pin, mode in state['modes'].items():
+                    x, y = get_pin_img_pos(pin, analog=False)
+                    draw.text((x+8, y-30), mode, font=font, fill=(0, 0, 0))
+                for pin, value in state['values'].items():
+                    x, y = get_pin_img_pos(pin, analog=False)
+                    draw.text((x+8, y-18), str(value), font=font, fill=(200, 0, 0))
+
+                arr = io.BytesIO()
+                im.save(arr, format="png")
+                self._frame = (seq, (
+                    b"--frame\r\n" b"Content-Type: image/png\r\n\r\n" + arr.getvalue() + b"\r\n"
+                ))
+            return self._frame[1]
 
     def show(self):
+        """
+        Yields the board image whenever the pins change. All viewers share
+        one rendering per state; a static board is only resent every few
+        seconds, so closed connections are noticed.
+        """
+        seq = None
         while True:
-            im = BOARD_IMG
-            draw = ImageDraw.Draw(im)
-            font = ImageFont.load_default()
-            
-            for pin, mode in self.pin_modes.items():
-                x, y = get_pin_img_pos(pin, analog=False)
-                draw.text((x+8, y-30), mode, font=font, fill=(0, 0, 0))
-
-            arr = io.BytesIO()
-            im.save(arr, format="png")
-            frame = arr.getvalue()
-            yield (
-                b"--frame\r\n" b"Content-Type: image/png\r\n\r\n" + frame + b"\r\n"
-            )
-            time.sleep(0.01)
-
+            seq, state = self.board.wait(seq, timeout=5)
+            yield self.frame(seq, state)
 
 if __name__ == '__main__':
 
+    import sys
     import time
 
-    a = Arduino(serial_port='/dev/cu.usbmodem142301')
+    # e.g. python arduino.py emulator
+    a = Arduino(serial_port=sys.argv[1] if len(sys.argv) > 1 else '/dev/cu.usbmodem142301')
     time.sleep(3)
     a.set_pin_mode(13,'O')
     for i in range(100):
@@ -143,4 +390,13 @@ if __name__ == '__main__':
     a.analog_write(5,245)
     print(a.digital_read(12))
     print(a.analog_read(2))
+    # Several reads in flight at once
+    reads = [a.analog_read_nowait(pin) for pin in range(6)]
+    print([read.result() for read in reads])
+    # Or all in one command
+    print(a.read_pins(['D12'] + [f'A{pin}' for pin in range(6)]))
+    a.subscribe(['D12', 'A0'], interval=50)
+    time.sleep(1)
+    print(a.latest('D12'), a.latest('A0'))
+    a.unsubscribe()
     time.sleep(5)
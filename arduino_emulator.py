@@ -0,0 +1,186 @@
+"""
+Software stand-in for an Arduino running pyduino_sketch, to test and
+benchmark the Arduino class without a board:
+
+    Arduino(serial_port='emulator')
+
+or pass an EmulatedSerial as the connection of anything that expects a
+pyserial port.
+"""
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+BITS_PER_BYTE = 10 # 8 data bits, a start and a stop bit
+
+
+class EmulatedSerial:
+    """
+    Serial port connected to an emulated board. A board thread handles the
+    commands of pyduino_sketch (M, RD, RA, WD, WA, B and S) after latency
+    seconds each, and bytes take as long as they would at baudrate in both
+    directions (baudrate=None for no limit).
+
+    Inputs can be set in digital_inputs and analog_inputs; reading an
+    output pin gives the value last written to it.
+    """
+
+    def __init__(self, port='emulator', baudrate=115200, timeout=None, latency=0.0005):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.latency = latency
+        self.pin_modes = {}
+        self.digital_inputs = {}
+        self.analog_inputs = {}
+        self.outputs = {} # pin -> last written value
+        self.commands = 0
+        self.subscribed = []
+        self.subscribe_interval = 0
+        self.last_sample = 0
+        self._received = b''
+        self._sent = bytearray()
+        self._sent_ready = 0 # bytes of _sent that are transferred already
+        self._transfers = [] # (time transferred, bytes) not yet readable
+        self._cond = threading.Condition()
+        self.is_open = True
+        self._thread = threading.Thread(target=self.run_forever, daemon=True)
+        self._thread.start()
+
+    def transfer_time(self, n_bytes):
+        return n_bytes * BITS_PER_BYTE / self.baudrate if self.baudrate else 0
+
+    # pyserial interface
+
+    def write(self, data):
+        # The port buffers what is written; it reaches the board at baudrate
+        time.sleep(self.transfer_time(len(data)))
+        with self._cond:
+            self._received += data
+            self._cond.notify_all()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._update()
+            return self._sent_ready
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        with self._cond:
+            while True:
+                self._update()
+                now = time.time()
+                if self._sent_ready >= size or (deadline is not None and now >= deadline):
+                    break
+                # Until the next bytes are transferred, or the timeout
+                waits = [t - now for t, _ in self._transfers[:1]]
+                if deadline is not None:
+                    waits.append(deadline - now)
+                self._cond.wait(max(min(waits), 0) if waits else None)
+            n = min(size, self._sent_ready)
+            data = bytes(self._sent[:n])
+            del self._sent[:n]
+            self._sent_ready -= n
+            return data
+
+    def readline(self):
+        line = b''
+        while not line.endswith(b'\n'):
+            byte = self.read(1)
+            if not byte:
+                break
+            line += byte
+        return line
+
+    def close(self):
+        with self._cond:
+            self.is_open = False
+            self._cond.notify_all() # wakes the board thread so it stops
+
+    # Board
+
+    def _update(self):
+        now = time.time()
+        while self._transfers and self._transfers[0][0] <= now:
+            _, data = self._transfers.pop(0)
+            self._sent_ready += len(data)
+
+    def send(self, line):
+        data = (line + '\r\n').encode() # Serial.println() ends lines with \r\n
+        with self._cond:
+            # Bytes go out one after another, after those still in transfer
+            start = max([time.time()] + [t for t, _ in self._transfers[-1:]])
+            self._transfers.append((start + self.transfer_time(len(data)), data))
+            self._sent += data
+            self._cond.notify_all()
+
+    def read_pin(self, pin):
+        mode, number = pin[0], int(pin[1:])
+        if mode == 'A':
+            return self.analog_inputs.get(number, 0)
+        if number in self.outputs:
+            return self.outputs[number]
+        return self.digital_inputs.get(number, 0)
+
+    def read_pins(self, prefix, pins):
+        self.send(prefix + ','.join(f'{pin}:{self.read_pin(pin)}' for pin in pins))
+
+    def handle_command(self, command):
+        self.commands += 1
+        operation, mode = command[0], command[1:2]
+        try:
+            if operation == 'R':
+                self.send(f'{mode}{int(command[2:])}:{self.read_pin(command[1:])}')
+            elif operation == 'W':
+                pin, value = command[2:].split(':')
+                self.outputs[int(pin)] = int(value)
+            elif operation == 'M':
+                self.pin_modes[int(command[2:])] = mode
+            elif operation == 'B':
+                self.read_pins('B', [pin for pin in command[1:].split(',') if pin])
+            elif operation == 'S':
+                interval, *pins = command[1:].split(',')
+                self.subscribe_interval = int(interval) / 1000
+                self.subscribed = [pin for pin in pins if pin]
+                self.last_sample = time.time()
+        except ValueError:
+            log.warning(f'Unexpected command {command!r}')
+
+    def run_forever(self):
+        while self.is_open:
+            with self._cond:
+                if b'\n' not in self._received and self.is_open:
+                    timeout = None
+                    if self.subscribe_interval and self.subscribed:
+                        timeout = max(self.last_sample + self.subscribe_interval - time.time(), 0)
+                    self._cond.wait(timeout)
+                line = None
+                if b'\n' in self._received:
+                    line, self._received = self._received.split(b'\n', 1)
+            if line is not None:
+                command = line.decode(errors='replace').strip()
+                if command:
+                    time.sleep(self.latency)
+                    self.handle_command(command)
+            # Stream the subscribed pins
+            if (self.subscribe_interval and self.subscribed
+                    and time.time() - self.last_sample >= self.subscribe_interval):
+                self.last_sample = time.time()
+                self.read_pins('S', self.subscribed)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    conn = EmulatedSerial(timeout=1)
+    conn.analog_inputs[0] = 512
+    for command in [b'MO13\n', b'WD13:1\n', b'RD13\n', b'RA0\n', b'BD13,A0,A1\n']:
+        conn.write(command)
+    for _ in range(3):
+        print(conn.readline())
+    conn.write(b'S100,D13,A0\n')
+    for _ in range(3):
+        print(conn.readline())
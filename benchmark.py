@@ -0,0 +1,470 @@
+"""
+Microbenchmarks for the VUmanoid pipeline.
+
+Usage examples:
+
+    python benchmark.py record --frames video.mp4 --out models/outs.npz
+    python benchmark.py decode --outputs models/outs.npz
+    python benchmark.py faces --fixtures faces/ --persons
+    python benchmark.py dnn --frames video.mp4 --configs yolov3:608 yolov3-tiny:320:openvino
+    python benchmark.py whisper --fixtures speech/ --configs greedy beam=5 greedy,int8
+    python benchmark.py gpt --backend rules:0.05 --inputs state-20230101-120000.txt
+    python benchmark.py arduino --baud-rates 9600 115200 --latency 0.001
+
+The repo has no fixtures: faces/ is a directory of images with a faces.json
+of their face boxes, speech/ one of 16 bit WAV files with .txt transcripts.
+"""
+import argparse
+import glob
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def timeit(fn, repeat):
+    """Runs fn repeat times and returns the mean time per call in ms"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def iter_frames(path, limit=None):
+    """Yields BGR frames from a video file or a directory of images"""
+    import cv2
+    if os.path.isdir(path):
+        files = sorted(glob.glob(os.path.join(path, '*')))
+        frames = (cv2.imread(f) for f in files)
+    else:
+        video = cv2.VideoCapture(path)
+        def read_video():
+            while True:
+                ret, frame = video.read()
+                if not ret:
+                    return
+                yield frame
+        frames = read_video()
+    for i, frame in enumerate(f for f in frames if f is not None):
+        if limit is not None and i >= limit:
+            return
+        yield frame
+
+
+def load_outputs(path):
+    """
+    Loads recorded YOLO outputs saved by the `record` command. Returns a list
+    of (outs, width, height) tuples.
+    """
+    data = np.load(path)
+    recorded = []
+    for i in range(int(data['n_frames'])):
+        outs = [data[f'f{i}_out{j}'] for j in range(int(data['n_layers']))]
+        recorded.append((outs, int(data[f'f{i}_width']), int(data[f'f{i}_height'])))
+    return recorded
+
+
+def synthetic_outputs(n_frames=10, seed=0):
+    """
+    Random outputs with the layer shapes of yolov3-tiny at 416x416, in case
+    no recording is available. Class scores are mostly zero like real outputs.
+    """
+    rng = np.random.default_rng(seed)
+    recorded = []
+    for _ in range(n_frames):
+        outs = []
+        for rows in (507, 2028):
+            out = rng.random((rows, 85), dtype=np.float32)
+            out[:, 5:] *= rng.random((rows, 80)) < 0.01
+            outs.append(out)
+        recorded.append((outs, 320, 240))
+    return recorded
+
+
+def record(args):
+    from vision import ObjectDetection
+    import cv2
+    detection = ObjectDetection(dnn_model=args.model, detect_faces=False)
+    arrays = {}
+    n_frames = 0
+    for i, frame in enumerate(iter_frames(args.frames, args.limit)):
+        blob = cv2.dnn.blobFromImage(
+            frame, 1/255, (detection.input_size,) * 2, swapRB=True, crop=False)
+        detection.MODEL.setInput(blob)
+        outs = detection.MODEL.forward(detection.OUTPUT_LAYERS)
+        for j, out in enumerate(outs):
+            arrays[f'f{i}_out{j}'] = out
+        arrays[f'f{i}_height'], arrays[f'f{i}_width'] = frame.shape[:2]
+        arrays['n_layers'] = len(outs)
+        n_frames = i + 1
+    np.savez_compressed(args.out, n_frames=n_frames, **arrays)
+    print(f'Recorded outputs of {n_frames} frames to {args.out}')
+
+
+def decode(args):
+    from vision import decode_outputs, decode_outputs_loop
+    if args.outputs:
+        recorded = load_outputs(args.outputs)
+    else:
+        print('No recorded outputs given, using synthetic yolov3-tiny outputs')
+        recorded = synthetic_outputs()
+
+    for outs, width, height in recorded:
+        expected = decode_outputs_loop(outs, width, height, args.threshold)
+        result = decode_outputs(outs, width, height, args.threshold)
+        assert expected == result, 'Decoded outputs differ'
+
+    def run(fn):
+        return lambda: [fn(o, w, h, args.threshold) for o, w, h in recorded]
+    loop_ms = timeit(run(decode_outputs_loop), args.repeat) / len(recorded)
+    vec_ms = timeit(run(decode_outputs), args.repeat) / len(recorded)
+    print(f'{len(recorded)} frames, threshold {args.threshold}')
+    print(f'loop:       {loop_ms:8.3f} ms/frame')
+    print(f'vectorized: {vec_ms:8.3f} ms/frame ({loop_ms / vec_ms:.1f}x faster)')
+
+
+def load_face_fixtures(path):
+    """
+    Loads the images of a fixture directory together with their annotated
+    face boxes from faces.json, which maps file names to [[x, y, w, h], ...]
+    """
+    import cv2
+    with open(os.path.join(path, 'faces.json')) as f:
+        annotations = json.load(f)
+    fixtures = []
+    for fname, boxes in sorted(annotations.items()):
+        image = cv2.imread(os.path.join(path, fname))
+        if image is None:
+            log.warning(f'Could not read fixture {fname}')
+            continue
+        fixtures.append((cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), image, boxes))
+    return fixtures
+
+
+def faces(args):
+    from vision import FaceDetector, ObjectDetection, load_face_cascade, iou
+    fixtures = load_face_fixtures(args.fixtures)
+    cascade = load_face_cascade()
+
+    persons = [None] * len(fixtures)
+    if args.persons:
+        detection = ObjectDetection(detect_faces=False)
+        persons = [
+            [d for d in detection.infer(image, threshold=0.01) if d.class_id == 0]
+            for _, image, _ in fixtures
+        ]
+
+    min_sizes = [None] + [(m, m) for m in args.min_sizes]
+    in_persons = [False, True] if args.persons else [False]
+    print(f'{len(fixtures)} fixtures, '
+          f'{sum(len(boxes) for _, _, boxes in fixtures)} annotated faces')
+    print(f'{"scale":>6} {"factor":>6} {"min":>5} {"roi":>5} {"ms/frame":>9} {"recall":>7} {"found":>6}')
+    for scale, factor, min_size, roi in itertools.product(
+            args.scales, args.scale_factors, min_sizes, in_persons):
+        detector = FaceDetector(cascade, scale=scale, scale_factor=factor,
+                                min_size=min_size, in_persons=roi)
+        hits = total = found = 0
+        start = time.perf_counter()
+        for (gray, _, boxes), frame_persons in zip(fixtures, persons):
+            result = [box for box, _ in detector.detect(gray, frame_persons)]
+            found += len(result)
+            total += len(boxes)
+            hits += sum(1 for box in boxes
+                        if any(iou(box, other) >= 0.5 for other in result))
+        ms = (time.perf_counter() - start) / len(fixtures) * 1000
+        recall = hits / total if total else float('nan')
+        print(f'{scale:6.2f} {factor:6.2f} {min_size[0] if min_size else "-":>5} '
+              f'{"yes" if roi else "no":>5} {ms:9.2f} {recall:7.2f} {found:6d}')
+
+
+def parse_dnn_config(config):
+    """Parses model[:input_size[:backend[:target]]]"""
+    parts = config.split(':')
+    model = parts[0]
+    size = int(parts[1]) if len(parts) > 1 else 416
+    backend = parts[2] if len(parts) > 2 else 'default'
+    target = parts[3] if len(parts) > 3 else 'cpu'
+    return model, size, backend, target
+
+
+def recall(reference, detections, min_iou=0.5):
+    """Fraction of reference detections found again with the same class"""
+    from vision import iou
+    found = sum(1 for r in reference if any(
+        d.class_id == r.class_id and iou(d.box, r.box) >= min_iou
+        for d in detections))
+    return found / len(reference) if reference else 1.0
+
+
+def dnn(args):
+    from vision import ObjectDetection
+    frames = list(iter_frames(args.frames, args.limit))
+    print(f'{len(frames)} frames, threshold {args.threshold}; recall is '
+          f'relative to {args.configs[0]}')
+    print(f'{"config":<40} {"mean ms":>8} {"p90 ms":>8} {"dets":>6} {"recall":>7}')
+    reference = None
+    for config in args.configs:
+        model, size, backend, target = parse_dnn_config(config)
+        detection = ObjectDetection(dnn_model=model, input_size=size, backend=backend,
+                                    target=target, detect_faces=False)
+        name = f'{model}:{size}:{detection.backend}:{detection.target}'
+        detection.infer(frames[0], args.threshold) # warm up
+
+        times, results = [], []
+        for frame in frames:
+            start = time.perf_counter()
+            results.append(detection.infer(frame, args.threshold))
+            times.append((time.perf_counter() - start) * 1000)
+
+        confident = [[d for d in r if d.confidence >= 0.5] for r in results]
+        if reference is None:
+            reference = confident
+        scores = [recall(ref, dets) for ref, dets in zip(reference, confident)]
+        print(f'{name:<40} {np.mean(times):8.1f} {np.percentile(times, 90):8.1f} '
+              f'{np.mean([len(d) for d in confident]):6.1f} {np.mean(scores):7.2f}')
+
+
+def parse_whisper_config(config):
+    """
+    Parses comma separated options into MicrophoneStreaming arguments, e.g.
+    'model=base,beam=5,nofallback,nocondition,threads=4,int8'
+    """
+    kwargs = {}
+    for option in config.split(','):
+        key, _, value = option.partition('=')
+        if key == 'model':
+            kwargs['model'] = value
+        elif key == 'greedy':
+            kwargs['beam_size'] = None
+        elif key == 'beam':
+            kwargs['beam_size'] = int(value or 5)
+        elif key == 'nofallback':
+            kwargs['temperature_fallback'] = False
+        elif key == 'nocondition':
+            kwargs['condition_on_previous_text'] = False
+        elif key == 'threads':
+            kwargs['threads'] = int(value)
+        elif key == 'int8':
+            kwargs['quantize'] = True
+        else:
+            raise ValueError(f'Unknown whisper option {option}')
+    return kwargs
+
+
+def whisper(args):
+    import editdistance
+    from hearing import MicrophoneStreaming, tokenize, read_wav
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(args.fixtures, '*.wav'))):
+        reference = os.path.splitext(path)[0] + '.txt'
+        text = open(reference).read() if os.path.exists(reference) else None
+        fixtures.append((os.path.basename(path), read_wav(path), text))
+    duration = sum(len(audio) for _, audio, _ in fixtures) / 16000
+    print(f'{len(fixtures)} fixtures, {duration:.1f}s of audio')
+    print(f'{"config":<32} {"RTF":>6} {"p50 s":>6} {"p90 s":>6} {"p99 s":>6} {"WER":>6}')
+
+    for config in args.configs:
+        kwargs = {'model': args.model, **parse_whisper_config(config)}
+        audio = MicrophoneStreaming(enabled=False, **kwargs)
+        audio.transcribe(data=fixtures[0][1], emit=False) # warm up
+
+        latencies, errors, words = [], 0, 0
+        for name, samples, reference in fixtures:
+            start = time.perf_counter()
+            result = audio.transcribe(data=samples, emit=False)
+            latencies.append(time.perf_counter() - start)
+            if reference is not None:
+                errors += editdistance.eval(tokenize(result['text']), tokenize(reference))
+                words += len(tokenize(reference))
+            log.debug(f'{config} {name}: {result["text"]!r}')
+
+        wer = f'{errors / words:6.3f}' if words else f'{"-":>6}'
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(f'{config:<32} {sum(latencies) / duration:6.3f} '
+              f'{p50:6.2f} {p90:6.2f} {p99:6.2f} {wer}')
+
+
+def load_inputs(path):
+    """(keyword, content) of the inputs in a state log"""
+    inputs = []
+    for line in open(path, encoding='utf-8').read().splitlines():
+        if line[:1] == '<' and ' ' in line:
+            inputs.append(tuple(line[1:].split(' ', 1)))
+    return inputs
+
+
+def synthetic_inputs(count=200, seed=0):
+    """Mostly SEE inputs of a few things, with a question now and then"""
+    rng = np.random.default_rng(seed)
+    things = ['👤', '🚲', '🐈', '🪑', '📱', '☕']
+    questions = ['What do you see?', 'Turn the LED on', 'Turn the LED off']
+    inputs = []
+    for i in range(count):
+        if rng.random() < 0.1:
+            inputs.append(('HEAR', questions[rng.integers(len(questions))]))
+        else:
+            seen = rng.choice(things, size=rng.integers(1, 3), replace=False)
+            inputs.append(('SEE', ', '.join(seen)))
+    return inputs
+
+
+def gpt(args):
+    from events import EventBus
+    from gpt import GPTConnection, ResponseWorker, make_backend
+    from state import State
+    inputs = load_inputs(args.inputs) if args.inputs else synthetic_inputs(args.count)
+    cache = dict(maxsize=256, ttl=600, key_messages=args.key_messages) if args.cache else None
+    state = State(os.path.join(tempfile.mkdtemp(), 'state.txt'))
+    bus = EventBus(maxsize=len(inputs) * 2 + 1)
+    State.bus = bus
+    worker = ResponseWorker(GPTConnection(state, 'You are a humanoid robot.', '', None,
+                                          backend=make_backend(args.backend, cache)))
+
+    def handle_event(event):
+        seq = state.log(event.message)
+        if event.message[0] == '<':
+            worker.submit(*event.message[1:].split(' ', 1), seq)
+    bus.subscribe(handle_event)
+    bus.start()
+
+    start = time.perf_counter()
+    for keyword, content in inputs:
+        State.input(keyword, content)
+        if args.interval:
+            time.sleep(args.interval)
+    def settled():
+        # An event can be taken off the bus before the worker has its input,
+        # so the bus counts have to stay the same around the worker check
+        counts = bus.published, bus.dispatched
+        return (counts[0] == counts[1] and not (worker.depth() or worker.busy)
+                and (bus.published, bus.dispatched) == counts)
+    while not settled():
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    stats = worker.stats()
+    print(f'{len(inputs)} inputs in {elapsed:.2f}s ({len(inputs) / elapsed:.1f}/s), '
+          f'{stats["processed"]} calls, {stats["merged"]} merged, {stats["failed"]} failed')
+    print(f'call latency max {stats["max_latency"] * 1000:.0f}ms, '
+          f'last input waited {stats["wait_time"] * 1000:.0f}ms')
+    if stats['backend']:
+        print(f'backend {stats["backend"]}')
+
+
+def arduino(args):
+    from arduino import Arduino
+    pins = [f'A{pin}' for pin in range(args.pins)]
+    print(f'{"port":<24} {"baud":>7} {"reads/s":>8} {"pipelined/s":>12} '
+          f'{"batch pins/s":>13} {"writes/s":>9}')
+    for baud_rate in args.baud_rates:
+        board = Arduino(serial_port=args.port, baud_rate=baud_rate)
+        if not board.enabled:
+            return
+        if args.port == 'emulator':
+            board.conn.latency = args.latency
+
+        def rate(fn, count):
+            start = time.perf_counter()
+            fn(count)
+            return count / (time.perf_counter() - start)
+
+        try:
+            # One read at a time, waiting for each reply
+            reads = rate(lambda n: [board.analog_read(0) for _ in range(n)], args.count)
+            # Reads sent without waiting for the replies
+            pipelined = rate(lambda n: [f.result() for f in
+                                        [board.analog_read_nowait(0) for _ in range(n)]], args.count)
+            # Many pins per read
+            batch = rate(lambda n: [board.read_pins(pins) for _ in range(n)],
+                         args.count // args.pins) * args.pins
+            writes = rate(lambda n: [board.digital_write(13, i % 2) for i in range(n)][-1].result(),
+                          args.count)
+        except TimeoutError:
+            print(f'{args.port:<24} {baud_rate:>7} no reply; is the sketch running at this baud rate?')
+            board.close()
+            continue
+        print(f'{args.port:<24} {baud_rate:>7} {reads:8.0f} {pipelined:12.0f} '
+              f'{batch:13.0f} {writes:9.0f}')
+        log.info(f'{board.stats()}')
+        board.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('record', help='record YOLO outputs of frames')
+    p.add_argument('--frames', required=True, help='video file or image dir')
+    p.add_argument('--out', default='models/outs.npz')
+    p.add_argument('--model', default='yolov3-tiny')
+    p.add_argument('--limit', type=int, default=50)
+    p.set_defaults(func=record)
+
+    p = commands.add_parser('decode', help='YOLO output decoding speed')
+    p.add_argument('--outputs', help='outputs recorded with `record`')
+    p.add_argument('--threshold', type=float, default=0.01)
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=decode)
+
+    p = commands.add_parser('faces', help='face detection speed and recall')
+    p.add_argument('--fixtures', required=True,
+                   help='directory of images with a faces.json of face boxes')
+    p.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.5, 0.35])
+    p.add_argument('--scale-factors', type=float, nargs='+', default=[1.1, 1.2])
+    p.add_argument('--min-sizes', type=int, nargs='+', default=[40, 80])
+    p.add_argument('--persons', action='store_true',
+                   help='also try searching inside YOLO person boxes')
+    p.set_defaults(func=faces)
+
+    p = commands.add_parser('dnn', help='latency and detections per DNN config')
+    p.add_argument('--frames', required=True, help='video file or image dir')
+    p.add_argument('--configs', nargs='+', default=[
+        'yolov3:608', 'yolov3-tiny:608', 'yolov3-tiny:416', 'yolov3-tiny:320',
+        'yolov3-tiny:416:openvino', 'yolov3-tiny:320:openvino'],
+        help='model[:input_size[:backend[:target]]], the first is the reference')
+    p.add_argument('--threshold', type=float, default=0.01)
+    p.add_argument('--limit', type=int, default=50)
+    p.set_defaults(func=dnn)
+
+    p = commands.add_parser('whisper', help='transcription speed and accuracy')
+    p.add_argument('--fixtures', required=True,
+                   help='directory of WAV files, each with an optional .txt transcript')
+    p.add_argument('--model', default='tiny')
+    p.add_argument('--configs', nargs='+', default=[
+        'greedy', 'beam=5', 'greedy,nofallback', 'greedy,nofallback,nocondition',
+        'greedy,int8'], help='comma separated options, see parse_whisper_config')
+    p.set_defaults(func=whisper)
+
+    p = commands.add_parser('gpt', help='throughput of the input loop with a completion backend')
+    p.add_argument('--backend', default='rules',
+                   help="'rules[:delay]', 'replay:<state log>' or 'openai'")
+    p.add_argument('--inputs', help='state log to take the inputs from')
+    p.add_argument('--count', type=int, default=200, help='number of synthetic inputs')
+    p.add_argument('--interval', type=float, default=0.01, help='seconds between inputs')
+    p.add_argument('--no-cache', dest='cache', action='store_false')
+    p.add_argument('--key-messages', type=int, default=3)
+    p.set_defaults(func=gpt)
+
+    p = commands.add_parser('arduino', help='serial command round trips per second')
+    p.add_argument('--port', default='emulator', help="serial port, or 'emulator'")
+    p.add_argument('--baud-rates', type=int, nargs='+', default=[9600, 115200])
+    p.add_argument('--latency', type=float, default=0.0005,
+                   help='seconds the emulated board takes per command')
+    p.add_argument('--count', type=int, default=200)
+    p.add_argument('--pins', type=int, default=6, help='analog pins per batch read')
+    p.set_defaults(func=arduino)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
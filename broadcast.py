@@ -0,0 +1,73 @@
+import threading
+import time
+
+
+class Broadcast:
+    """
+    Holds the latest published value (e.g. an encoded frame) for any number of
+    readers. Publishing never waits for readers; a reader that falls behind
+    simply gets the newest value and skips the ones in between. Once the
+    producer is done it closes the broadcast, which ends the subscriptions.
+    """
+
+    def __init__(self, value=None):
+        self._cond = threading.Condition()
+        self._value = value
+        self._seq = 0
+        self._closed = False
+
+    @property
+    def seq(self):
+        return self._seq
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def publish(self, value):
+        with self._cond:
+            self._value = value
+            self._seq += 1
+            self._cond.notify_all()
+
+    def latest(self):
+        with self._cond:
+            return self._seq, self._value
+
+    def wait(self, last_seq=0, timeout=None):
+        """
+        Blocks until a value newer than last_seq is published (or timeout) and
+        returns (seq, value). On timeout or close the current value is
+        returned, so callers can tell by comparing seq with last_seq.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq != last_seq or self._closed, timeout)
+            return self._seq, self._value
+
+    def subscribe(self, timeout=None, resend=None):
+        """
+        Generator yielding each new value, skipping any that were published
+        while the consumer was busy. With resend, the latest value is yielded
+        again after resend seconds without a new one, so that a consumer
+        writing to a connection notices when it was closed. Ends when the
+        broadcast is closed.
+        """
+        seq = 0
+        sent = time.monotonic()
+        while True:
+            new_seq, value = self.wait(seq, timeout if resend is None else
+                                       min(timeout or resend, resend))
+            if new_seq == seq and self._closed:
+                return
+            if value is None:
+                continue
+            if new_seq != seq or (resend is not None and
+                                  time.monotonic() - sent >= resend):
+                seq = new_seq
+                sent = time.monotonic()
+                yield value
@@ -5,8 +5,12 @@ import logging
 attrib_list = {"exposure": cv2.CAP_PROP_EXPOSURE, "contrast": cv2.CAP_PROP_CONTRAST}
 
 
-def check_settings():
-    VIDEO_CHECK = cv2.VideoCapture(0)
+def check_settings(video=None):
+    """
+    Stores the camera settings on first use and restores them afterwards.
+    Pass an open cv2.VideoCapture to avoid opening the camera again.
+    """
+    VIDEO_CHECK = video if video is not None else cv2.VideoCapture(0)
 
     if not os.path.exists("camera_settings.log"):
         f = open("camera_settings.log", "w")
@@ -27,17 +31,18 @@ def check_settings():
     for attrib, index in attrib_list.items():
         logging.info(f"camera setting {attrib} = {VIDEO_CHECK.get(index)}")
 
-    VIDEO_CHECK.release()
+    if video is None:
+        VIDEO_CHECK.release()
 
 
-def reset_settings():
+def reset_settings(video=None):
     if not os.path.exists("camera_settings.log"):
-        logging.INFO(
+        logging.info(
             "'camera_settings.log' does not exist! " "Verify your camera settings!"
         )
         return False
     else:
-        VIDEO_CHECK = cv2.VideoCapture(0)
+        VIDEO_CHECK = video if video is not None else cv2.VideoCapture(0)
         f = open("camera_settings.log", "r")
         lines = f.read().split("\n")
         for line in lines:
@@ -45,5 +50,6 @@ def reset_settings():
             if attrib[0] in attrib_list.keys():
                 VIDEO_CHECK.set(attrib_list[attrib[0]], eval(attrib[1]))
         f.close()
-        VIDEO_CHECK.release()
+        if video is None:
+            VIDEO_CHECK.release()
     return True
@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+log = logging.getLogger(__name__)
+
+# timestamp is time.time() of when the event was produced
+Event = namedtuple('Event', ['message', 'timestamp'])
+
+
+class EventBus:
+    """
+    In-process publish/subscribe for state messages. Publishing never
+    blocks: events go into a bounded queue and a worker thread hands them
+    to the subscribers in order. When the queue is full, the oldest
+    sheddable event (a SEE input, by default) is dropped; other inputs
+    and outputs are always kept, even beyond maxsize.
+    """
+
+    def __init__(self, maxsize=100, sheddable=('<SEE',)):
+        self.maxsize = maxsize
+        self.sheddable = tuple(sheddable) # message prefixes that may be dropped
+        self.events = deque()
+        self.cond = threading.Condition()
+        self.subscribers = []
+        self.published = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.latency = 0.0 # of the last event, from publishing to handled
+        self.max_latency = 0.0
+        self._thread = None
+
+    def subscribe(self, handler):
+        """handler(event) is called for every event, in the worker thread"""
+        self.subscribers.append(handler)
+
+    def publish(self, message, timestamp=None):
+        event = Event(message, timestamp or time.time())
+        with self.cond:
+            if len(self.events) >= self.maxsize:
+                oldest = next((e for e in self.events
+                               if e.message.startswith(self.sheddable)), None)
+                if oldest is not None:
+                    self.events.remove(oldest)
+                    self.dropped += 1
+                    log.warning(f'Event queue full, dropped {oldest.message!r}')
+                elif message.startswith(self.sheddable):
+                    self.dropped += 1
+                    log.warning(f'Event queue full, dropped {message!r}')
+                    return event
+            self.events.append(event)
+            self.published += 1
+            self.cond.notify()
+        return event
+
+    def qsize(self):
+        return len(self.events)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.dispatch_forever, daemon=True)
+            self._thread.start()
+
+    def dispatch_forever(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.events)
+                event = self.events.popleft()
+            for handler in self.subscribers:
+                try:
+                    handler(event)
+                except Exception as e:
+                    log.exception(e)
+            self.dispatched += 1
+            self.latency = time.time() - event.timestamp
+            self.max_latency = max(self.max_latency, self.latency)
+            log.debug(f'Handled {event.message!r} in {self.latency * 1000:.0f}ms')
+
+    def stats(self):
+        return {
+            'queued': self.qsize(),
+            'published': self.published,
+            'dispatched': self.dispatched,
+            'dropped': self.dropped,
+            'latency': round(self.latency, 3),
+            'max_latency': round(self.max_latency, 3),
+        }
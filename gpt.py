@@ -1,16 +1,345 @@
+import itertools
 import logging
 import openai
 import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
 
 from state import State
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 log = logging.getLogger(__name__)
 
+
+def split_seen(content):
+    """Splits SEE content like '🚲, 👤 (camera 1)' into (['🚲', '👤'], ' (camera 1)')"""
+    camera = ''
+    if content.endswith(')') and ' (' in content:
+        content, camera = content.rsplit(' (', 1)
+        camera = ' (' + camera
+    return [c for c in content.split(', ') if c], camera
+
+
+def parse_seen(content):
+    """
+    SEE content as a dict of camera -> things seen, also for merged inputs
+    like '🚲 (camera 0); 👤 (camera 1)'
+    """
+    seen = {}
+    for part in content.split('; '):
+        things, camera = split_seen(part)
+        seen.setdefault(camera, []).extend(things)
+    return seen
+
+
+def format_seen(seen):
+    """SEE content of a dict of camera -> things seen"""
+    return '; '.join(', '.join(things) + camera for camera, things in seen.items())
+
+
+class ContextBuilder:
+    """
+    Builds the chat messages for a request within a token budget: the system
+    prompt and the current input always go in, then as many of the most
+    recent state lines as fit. Older lines are collapsed into one short
+    summary message, and repeated SEE inputs are left out.
+    """
+
+    def __init__(self, budget=3000, reply_tokens=256, summary_tokens=200, model='gpt-3.5-turbo'):
+        self.budget = budget
+        self.reply_tokens = reply_tokens # kept free for the reply
+        self.summary_tokens = summary_tokens
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except Exception as e:
+                log.warning(f'No tokenizer for {model}, estimating token counts: {e}')
+
+    def count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        # Rough estimate for English text without the tokenizer
+        return len(text) // 4 + 1
+
+    def count_message(self, message):
+        # Every message has a few tokens of overhead for its role and separators
+        return self.count(message['content']) + 4
+
+    def turns(self, state, until, exclude=(), max_lines=1000):
+        """
+        Yields the turns up to sequence number until, newest first: an input
+        line with the lines that followed it. Inputs with a sequence number
+        in exclude (e.g. not answered yet) are left out, and so are SEE
+        inputs that repeat the next SEE, together with their replies, so a
+        static scene takes up one turn. Reads at most max_lines lines of the
+        state, in chunks, so the cost does not grow with the session.
+        """
+        replies = []
+        later_see = None
+        end = until
+        # Lines before the offset were cleared
+        while end > state.offset and until - end < max_lines:
+            start = max(state.offset, end - 64)
+            lines = state.lines(start, until=end)
+            for seq in range(end, start, -1):
+                line = lines[seq - start - 1]
+                if not line:
+                    continue
+                if line[0] != '<':
+                    replies.insert(0, line)
+                    continue
+                turn, replies = [line] + replies, []
+                if seq in exclude:
+                    continue
+                if line.startswith('<SEE'):
+                    if line == later_see:
+                        continue
+                    later_see = line
+                yield turn
+            end = start
+        if replies:
+            yield replies
+
+    def summarize(self, turns):
+        """
+        Collapses older turns, newest first, into one message listing what
+        was seen, heard and done, up to summary_tokens
+        """
+        seen, other, known = [], [], set()
+        tokens = self.count('Earlier: SEE ')
+        for turn in turns:
+            for line in reversed(turn):
+                if line.startswith('<SEE '):
+                    parts, into = split_seen(line[5:])[0], seen
+                elif not line.startswith('>WAIT'):
+                    parts, into = [line[1:]], other
+                else:
+                    continue
+                parts = [part for part in parts if part not in known]
+                tokens += sum(self.count(part) + 1 for part in parts)
+                if tokens > self.summary_tokens:
+                    break
+                known.update(parts)
+                into.extend(parts)
+            if tokens > self.summary_tokens:
+                break
+        if not seen and not other:
+            return None
+        # Oldest first, like the rest of the conversation
+        summary = other[::-1] + (['SEE ' + ', '.join(seen[::-1])] if seen else [])
+        return {"role": "system", "content": 'Earlier: ' + '; '.join(summary)}
+
+    def build(self, system, state, current, until=None, exclude=()):
+        """
+        Returns (messages, prompt tokens) for the current input and the state
+        lines up to sequence number until (all of them by default), without
+        the inputs in exclude
+        """
+        system = {"role": "system", "content": system}
+        current = {"role": "user", "content": current}
+        if until is None:
+            until = state.seq
+            # The current input is usually logged already before responding
+            last = state.lines(until - 1, until=until) if until else []
+            if last and last[0][1:] == current['content']:
+                until -= 1
+
+        available = (self.budget - self.reply_tokens - self.summary_tokens
+                     - self.count_message(system) - self.count_message(current))
+        recent = []
+        turns = self.turns(state, until, exclude)
+        for turn in turns:
+            # outputs (>) are assistant messages, inputs (<) are user messages
+            messages = [{"role": ("assistant" if line[0] == '>' else "user"),
+                         "content": line[1:]} for line in turn]
+            available -= sum(self.count_message(m) for m in messages)
+            if available < 0:
+                summary = self.summarize(itertools.chain([turn], turns))
+                break
+            recent[:0] = messages
+        else:
+            summary = None
+        # Don't start with replies to an input that is not there
+        while recent and recent[0]['role'] == 'assistant':
+            recent.pop(0)
+
+        messages = [system] + ([summary] if summary else []) + recent + [current]
+        tokens = sum(self.count_message(m) for m in messages)
+        return messages, tokens
+
+
+class OpenAIBackend:
+    """Completions from the OpenAI chat API"""
+
+    def __init__(self, model='gpt-3.5-turbo'):
+        self.model = model
+
+    def complete(self, messages, max_tokens=None, timeout=None):
+        completion = openai.ChatCompletion.create(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            request_timeout=timeout,
+        )
+        log.info(f'Usage {dict(completion.get("usage", {}))}')
+        return completion.choices[0].message.content
+
+
+def normalize(content):
+    """Collapses whitespace and sorts the things in SEE inputs, so equal prompts compare equal"""
+    content = ' '.join(content.split())
+    if content.startswith('SEE '):
+        seen = parse_seen(content[4:])
+        content = 'SEE ' + format_seen({camera: sorted(things) for camera, things in sorted(seen.items())})
+    return content
+
+
+class CachedBackend:
+    """
+    Remembers the replies of another backend by normalized prompt, for at most
+    ttl seconds and maxsize prompts (least recently used go first). With
+    key_messages, only the system prompt, the current input and that many
+    messages before it make up the key (0 for none), so the same input in a
+    similar context is answered from the cache even when older turns differ. HEAR inputs are always keyed on
+    the whole context, as their answer depends on the conversation so far.
+    """
+
+    def __init__(self, backend, maxsize=256, ttl=600, key_messages=None):
+        self.backend = backend
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key_messages = key_messages
+        self.cache = OrderedDict() # key -> (time, reply)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, messages):
+        if self.key_messages is not None and not messages[-1]['content'].startswith('HEAR'):
+            context = messages[1:-1]
+            # [-0:] would be all of them
+            recent = context[-self.key_messages:] if self.key_messages else []
+            messages = messages[:1] + recent + messages[-1:]
+        return tuple((m['role'], normalize(m['content'])) for m in messages)
+
+    def complete(self, messages, max_tokens=None, timeout=None):
+        key = self.key(messages)
+        now = time.time()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached and now - cached[0] < self.ttl:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        reply = self.backend.complete(messages, max_tokens, timeout)
+        with self.lock:
+            self.cache[key] = (now, reply)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return reply
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'cached': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+        }
+
+
+class RuleBackend:
+    """
+    Local stand-in for the model that follows the persona with a few rules:
+    WAIT on SEE, switch the LED when asked to and otherwise SAY what was seen
+    last. Replies take delay seconds, to simulate a remote model.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+
+    def complete(self, messages, max_tokens=None, timeout=None):
+        if self.delay:
+            time.sleep(self.delay)
+        keyword, _, content = messages[-1]['content'].partition(' ')
+        if keyword != 'HEAR':
+            return 'WAIT'
+        words = re.findall(r'\w+', content.lower())
+        if 'led' in words or 'light' in words:
+            return 'LED 0' if 'off' in words else 'LED 1'
+        for message in reversed(messages[:-1]):
+            if message['role'] == 'user' and message['content'].startswith('SEE '):
+                return f'SAY I see {message["content"][4:]}.'
+        return 'SAY I don\'t see anything.'
+
+
+class ReplayBackend:
+    """
+    Local stand-in for the model that gives the replies recorded in state
+    logs of earlier sessions, and WAIT for inputs it has no reply for.
+    """
+
+    def __init__(self, *fnames):
+        self.replies = {}
+        for fname in fnames:
+            lines = [line for line in open(fname, encoding='utf-8').read().splitlines() if line]
+            for line, next_line in zip(lines, lines[1:]):
+                if line[0] == '<' and next_line[0] == '>':
+                    self.replies[normalize(line[1:])] = next_line[1:]
+        self.hits = 0
+        self.misses = 0
+        log.info(f'Loaded {len(self.replies)} recorded replies')
+
+    def complete(self, messages, max_tokens=None, timeout=None):
+        reply = self.replies.get(normalize(messages[-1]['content']))
+        if reply is None:
+            self.misses += 1
+            return 'WAIT'
+        self.hits += 1
+        return reply
+
+    def stats(self):
+        return {'recorded': len(self.replies), 'hits': self.hits, 'misses': self.misses}
+
+
+def make_backend(spec='openai', cache=None):
+    """
+    Backend from a spec like 'openai', 'openai:gpt-4', 'rules', 'rules:0.5'
+    (seconds of delay) or 'replay:state-1.txt,state-2.txt', optionally
+    wrapped in a CachedBackend with the cache settings
+    """
+    name, _, arg = spec.partition(':')
+    if name == 'openai':
+        backend = OpenAIBackend(arg or 'gpt-3.5-turbo')
+    elif name == 'rules':
+        backend = RuleBackend(float(arg or 0))
+    elif name == 'replay':
+        backend = ReplayBackend(*arg.split(','))
+    else:
+        raise ValueError(f'Unknown completion backend {spec}')
+    if cache is not None:
+        backend = CachedBackend(backend, **cache)
+    return backend
+
+
 class GPTConnection:
-    def __init__(self, state_obj: State, persona: str, mindmap: str, api_key:str):
+    def __init__(self, state_obj: State, persona: str, mindmap: str, api_key:str,
+                 context_budget=3000, reply_tokens=256, request_timeout=30, backend=None):
         self.state = state_obj
+        self.backend = backend or OpenAIBackend()
+        self.request_timeout = request_timeout
         self.persona = persona
         self.mindmap = mindmap
+        self.context = ContextBuilder(budget=context_budget, reply_tokens=reply_tokens)
         print(self.mindmap)
         if not api_key:
             api_key = self.get_key()
@@ -27,24 +356,148 @@ class GPTConnection:
             log.info(f'Using OpenAI API key {api_key}')
             openai.api_key = api_key
     
-    def respond(self, keyword, content):
-        old_messages = [
-            # outputs (>) are assistant messages, inputs (<) are user messages
-            {"role": ("assistant" if m[0] == '>' else "user"), "content": m[1:]}
-            for m in self.state.read().splitlines()
-        ]
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=(
-                [{"role": "system", "content": self.persona + self.mindmap}]
-                + old_messages
-                + [{"role": "user", "content": f"{keyword} {content}"}]
-            )
-        )
-        reply = completion.choices[0].message.content.replace('\n','')
+    def complete(self, keyword, content, until=None, exclude=()):
+        """
+        Asks the model for a reply to an input and returns (keyword, content);
+        until and exclude select the state lines before it (see
+        ContextBuilder.build)
+        """
+        messages, tokens = self.context.build(
+            self.persona + self.mindmap, self.state, f"{keyword} {content}", until, exclude)
+        start = time.time()
+        reply = self.backend.complete(messages, self.context.reply_tokens, self.request_timeout)
+        latency = time.time() - start
+        log.info(f'Prompt of {len(messages)} messages, {tokens} tokens, reply in {latency:.2f}s')
+        reply = reply.replace('\n','')
         log.info(f'Got reply {reply}')
         if ' ' in reply:
-            reply_keyword, reply_content = reply.split(' ', 1)
-        else:
-            reply_keyword, reply_content = reply, ''
-        return self.state.output(reply_keyword, reply_content)
+            return tuple(reply.split(' ', 1))
+        return reply, ''
+
+    def respond(self, keyword, content):
+        return self.state.output(*self.complete(keyword, content))
+
+
+class ResponseWorker:
+    """
+    Makes the model calls one at a time in a background thread, so inputs
+    never wait for the model. SEE inputs that arrive while a call is in
+    flight are merged into one, and HEAR (and any other) inputs are answered
+    before them.
+    """
+
+    def __init__(self, gpt: GPTConnection):
+        self.gpt = gpt
+        self.cond = threading.Condition()
+        self.inputs = deque() # (keyword, content, time submitted, seqs), in order
+        self.seen = {} # camera -> things seen, for the pending SEE input
+        self.seen_time = None
+        self.seen_seqs = [] # state sequence numbers of the merged SEE inputs
+        self.generation = 0 # incremented on cancel, to drop replies in flight
+        self.busy = False
+        self.processed = 0
+        self.merged = 0
+        self.cancelled = 0
+        self.failed = 0
+        self.latency = 0.0 # of the last model call
+        self.max_latency = 0.0
+        self.wait_time = 0.0 # of the last input, from submitted to answered
+        self._thread = None
+
+    def submit(self, keyword, content, seq=None):
+        """
+        Queues an input; seq is its sequence number in the state, so that the
+        context is cut off before it
+        """
+        seqs = [seq] if seq is not None else []
+        with self.cond:
+            if keyword == 'SEE':
+                if self.seen_time is None:
+                    self.seen_time = time.time()
+                else:
+                    self.merged += 1
+                for camera, things in parse_seen(content).items():
+                    seen = self.seen.setdefault(camera, [])
+                    seen.extend(thing for thing in things if thing not in seen)
+                self.seen_seqs.extend(seqs)
+            else:
+                self.inputs.append((keyword, content, time.time(), seqs))
+            self.cond.notify()
+        self.start()
+
+    def cancel(self):
+        """Drops the pending inputs and the reply to the call in flight"""
+        with self.cond:
+            self.cancelled += len(self.inputs) + bool(self.seen) + self.busy
+            self.inputs.clear()
+            self.seen = {}
+            self.seen_time = None
+            self.seen_seqs = []
+            self.generation += 1
+
+    def depth(self):
+        return len(self.inputs) + bool(self.seen)
+
+    def next_input(self):
+        if self.inputs:
+            return self.inputs.popleft()
+        item = 'SEE', format_seen(self.seen), self.seen_time, self.seen_seqs
+        self.seen = {}
+        self.seen_time = None
+        self.seen_seqs = []
+        return item
+
+    def pending_seqs(self):
+        return set(self.seen_seqs).union(*(seqs for *_, seqs in self.inputs))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.work_forever, daemon=True)
+            self._thread.start()
+
+    def work_forever(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(self.depth)
+                keyword, content, submitted, seqs = self.next_input()
+                # The context ends before this input and leaves out the ones
+                # that are still waiting (e.g. SEE inputs a HEAR went ahead of)
+                until = min(seqs) - 1 if seqs else None
+                exclude = self.pending_seqs()
+                generation = self.generation
+                self.busy = True
+            start = time.time()
+            try:
+                reply = self.gpt.complete(keyword, content, until, exclude)
+            except Exception as e:
+                # Includes timeouts (openai.error.Timeout)
+                log.error(f'No reply to {keyword} {content}: {e}')
+                self.failed += 1
+                reply = None
+            self.latency = time.time() - start
+            self.max_latency = max(self.max_latency, self.latency)
+            with self.cond:
+                cancelled = generation != self.generation
+            if cancelled:
+                log.info(f'Dropped reply {reply} to cancelled {keyword} {content}')
+            elif reply is not None:
+                self.gpt.state.output(*reply)
+                self.processed += 1
+                self.wait_time = time.time() - submitted
+            # Only idle once the reply is out
+            with self.cond:
+                self.busy = False
+
+    def stats(self):
+        return {
+            'queued': self.depth(),
+            'busy': self.busy,
+            'processed': self.processed,
+            'merged': self.merged,
+            'cancelled': self.cancelled,
+            'failed': self.failed,
+            'latency': round(self.latency, 3),
+            'max_latency': round(self.max_latency, 3),
+            'wait_time': round(self.wait_time, 3),
+            'backend': self.gpt.backend.stats() if hasattr(self.gpt.backend, 'stats') else {},
+        }
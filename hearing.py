@@ -5,7 +5,6 @@ from PIL import Image, ImageDraw, ImageFont
 import io
 import torch
 import whisper
-import queue
 import threading
 import numpy as np
 import time
@@ -15,8 +14,13 @@ from datetime import datetime
 import editdistance
 import string
 import re
+import os
+import glob
+import queue
+import wave
 
 from state import State
+from broadcast import Broadcast
 
 MIC_IMG = Image.open("static/mic.png").convert("RGBA")
 
@@ -26,6 +30,194 @@ def tokenize(s: str):
     s = s.translate(str.maketrans('', '', string.punctuation))
     return s.lower().split()
 
+def read_wav(path, sample_rate=16000):
+    """Reads a 16 bit WAV file as mono float32 samples at sample_rate"""
+    with wave.open(path, 'rb') as f:
+        width, channels, rate = f.getsampwidth(), f.getnchannels(), f.getframerate()
+        data = f.readframes(f.getnframes())
+    if width != 2:
+        raise ValueError(f'{path}: only 16 bit WAV files are supported')
+    samples = np.frombuffer(data, np.int16).reshape(-1, channels).mean(axis=1)
+    if rate != sample_rate:
+        duration = len(samples) / rate
+        t = np.arange(int(duration * sample_rate)) / sample_rate
+        samples = np.interp(t, np.arange(len(samples)) / rate, samples)
+    return (samples / 32768.0).astype(np.float32)
+
+
+class WavSource(sr.AudioSource):
+    """
+    Plays WAV files (a file, a directory or a list of files) as if they were
+    the microphone, at real-time speed or as fast as possible. After the
+    last file it keeps producing silence at real-time speed, like a quiet
+    room, unless loop is set.
+    """
+
+    def __init__(self, files, realtime=True, loop=False, sample_rate=16000, chunk=1024):
+        if isinstance(files, str):
+            files = sorted(glob.glob(os.path.join(files, '*.wav'))) if os.path.isdir(files) else [files]
+        samples = np.concatenate([read_wav(f, sample_rate) for f in files])
+        self.samples = (samples * 32768).clip(-32768, 32767).astype(np.int16)
+        self.realtime = realtime
+        self.loop = loop
+        self.SAMPLE_RATE = sample_rate
+        self.SAMPLE_WIDTH = 2
+        self.CHUNK = chunk
+        self.stream = None
+
+    def __enter__(self):
+        self.stream = WavSource.Stream(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream = None
+
+    class Stream:
+        def __init__(self, source):
+            self.source = source
+            self.position = 0
+            self.start = time.time()
+
+        def read(self, size):
+            source = self.source
+            end = self.position + size
+            if end > len(source.samples) and source.loop:
+                self.position, end = 0, size
+            if self.position >= len(source.samples):
+                # Silence after the last file, paced so it does not spin
+                time.sleep(size / source.SAMPLE_RATE)
+                return bytes(size * source.SAMPLE_WIDTH)
+            chunk = source.samples[self.position:end]
+            self.position += len(chunk)
+            if source.realtime:
+                delay = self.start + self.position / source.SAMPLE_RATE - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            return chunk.tobytes()
+
+
+class MeteredSource(sr.AudioSource):
+    """
+    Wraps an AudioSource and passes the RMS level of every chunk that is
+    read from it to on_level, so the level meter can reuse the audio that
+    is recorded anyway instead of opening the microphone a second time.
+    """
+
+    def __init__(self, source, on_level):
+        self.source = source
+        self.on_level = on_level
+        self.stream = None
+
+    def __getattr__(self, name):
+        # SAMPLE_RATE, SAMPLE_WIDTH, CHUNK, ...
+        return getattr(self.source, name)
+
+    def __enter__(self):
+        self.source.__enter__()
+        self.stream = MeteredSource.Stream(self.source, self.on_level)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream = None
+        return self.source.__exit__(exc_type, exc_value, traceback)
+
+    class Stream:
+        def __init__(self, source, on_level):
+            self.source = source
+            self.on_level = on_level
+
+        def read(self, size):
+            buffer = self.source.stream.read(size)
+            self.on_level(audioop.rms(buffer, self.source.SAMPLE_WIDTH))
+            return buffer
+
+        def close(self):
+            self.source.stream.close()
+
+
+def quantize_model(model):
+    """Dynamic int8 quantization of the linear layers of a Whisper model"""
+    for module in model.modules():
+        # Whisper's Linear only differs in casting its weights to the input
+        # dtype, and quantize_dynamic only recognizes plain nn.Linear layers
+        if isinstance(module, torch.nn.Linear):
+            module.__class__ = torch.nn.Linear
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class AudioRing:
+    """
+    Preallocated ring buffer of int16 samples. The microphone callback
+    writes into it and the transcriber blocks until there is audio, then
+    gets it converted into a reused float32 array. When the reader falls
+    behind more than the buffer size, the oldest audio is dropped, unless
+    block is set: then the writer waits for the reader (e.g. when replaying
+    files as fast as they can be transcribed).
+    """
+
+    def __init__(self, seconds: float = 30, sample_rate: int = 16000, block: bool = False):
+        self.sample_rate = sample_rate
+        self.block = block
+        self.buffer = np.zeros(int(seconds * sample_rate), np.int16)
+        self.out = np.zeros(len(self.buffer), np.float32)
+        self.start = 0 # total samples read
+        self.end = 0 # total samples written
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def write(self, data) -> None:
+        samples = np.frombuffer(data, np.int16)
+        size = len(self.buffer)
+        if self.block:
+            for i in range(0, len(samples), size):
+                piece = samples[i:i + size]
+                with self.cond:
+                    self.cond.wait_for(lambda: size - (self.end - self.start) >= len(piece))
+                    self._write(piece)
+            return
+        with self.cond:
+            if len(samples) > size:
+                samples = samples[-size:]
+            self._write(samples)
+
+    def _write(self, samples) -> None:
+        # Called with the lock held
+        size = len(self.buffer)
+        pos = self.end % size
+        first = min(len(samples), size - pos)
+        self.buffer[pos:pos + first] = samples[:first]
+        self.buffer[:len(samples) - first] = samples[first:]
+        self.end += len(samples)
+        if self.end - self.start > size:
+            self.dropped += self.end - self.start - size
+            self.start = self.end - size
+        self.cond.notify_all()
+
+    def wait(self, timeout=None) -> bool:
+        """Blocks until there is audio to read; False on timeout"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.end > self.start, timeout)
+
+    def read(self) -> np.ndarray:
+        """
+        Returns all unread audio as float32 in [-1, 1). The array is a view
+        that is overwritten by the next read.
+        """
+        size = len(self.buffer)
+        with self.cond:
+            n = self.end - self.start
+            pos = self.start % size
+            first = min(n, size - pos)
+            np.multiply(self.buffer[pos:pos + first], 1 / 32768.0, out=self.out[:first])
+            np.multiply(self.buffer[:n - first], 1 / 32768.0, out=self.out[first:n])
+            self.start = self.end
+            self.cond.notify_all() # blocked writers
+        return self.out[:n]
+
+
 class MicrophoneStreaming:
     def __init__(
         self,
@@ -41,6 +233,20 @@ class MicrophoneStreaming:
         mic_index: int = None,
         no_speech_threshold: float = 0.5,
         ok_speech_threshold: float = 0.5,
+        lazy: bool = False,
+        streaming: bool = False,
+        partial_interval: float = 0.5,
+        partial_window: float = 5.0,
+        max_utterance: float = 20.0,
+        beam_size: int = None,
+        best_of: int = None,
+        temperature_fallback: bool = True,
+        condition_on_previous_text: bool = True,
+        initial_prompt: str = None,
+        threads: int = None,
+        quantize: bool = False,
+        source=None,
+        realtime: bool = True,
     ):
         self.energy = energy
         self.pause = pause
@@ -50,6 +256,33 @@ class MicrophoneStreaming:
         self.no_speech_threshold = no_speech_threshold
         self.ok_speech_threshold = ok_speech_threshold
 
+        # In streaming mode, speech is segmented by a simple energy VAD on
+        # continuously recorded audio. While someone speaks, the last
+        # partial_window seconds are decoded every partial_interval seconds
+        # as a partial hypothesis; after a pause the whole utterance is
+        # decoded once more and sent as HEAR.
+        self.streaming = streaming
+        self.partial_interval = partial_interval
+        self.partial_window = partial_window
+        self.max_utterance = max_utterance
+        self.partial = ''
+        self.latency = {'first_partial': None, 'final': None}
+
+        # Whisper decoding: greedy unless beam_size is set; without
+        # temperature fallback only temperature 0 is tried
+        self.decode_options = {
+            'condition_on_previous_text': condition_on_previous_text,
+            'initial_prompt': initial_prompt,
+        }
+        if beam_size:
+            self.decode_options['beam_size'] = beam_size
+        if best_of:
+            self.decode_options['best_of'] = best_of
+        if not temperature_fallback:
+            self.decode_options['temperature'] = 0.0
+        self.threads = threads
+        self.quantize = quantize # dynamic int8 quantization, CPU only
+
         self.platform = platform.system().lower()
         self.gpu = (device == 'cuda')
 
@@ -63,13 +296,17 @@ class MicrophoneStreaming:
 
         if (model != "large" and model != "large-v2") and self.english:
             model = model + ".en"
-        
-        log.info(f'Loading Whisper model {model}')
-        self.audio_model = whisper.load_model(model, download_root=model_root).to(
-            device
-        )
+        self.model = model
+        self.model_root = model_root
+        self.device = device
+        self.enabled = enabled
 
-        self.audio_queue = queue.Queue()
+        # Replaying files as fast as possible is paced by the transcriber
+        # instead: no audio is dropped and phrases are transcribed one by
+        # one, so a replay always gives the same inputs
+        self.paced = source is not None and not realtime
+        self.audio_ring = AudioRing(sample_rate=16000, block=self.paced)
+        self.phrases = queue.Queue(maxsize=1)
         self.last_result_time = (None, datetime.now())
         self.last_ok_text_time = ('', datetime.now())
 
@@ -77,29 +314,71 @@ class MicrophoneStreaming:
         self.mic_index  = mic_index
         self.islocked = False
 
-        if self.mic_index is None:
-            log.info("No mic index provided, using default")
-        self.source = sr.Microphone(sample_rate=16000, device_index=self.mic_index)
+        if source is not None:
+            # Replay WAV files instead of recording from the microphone
+            log.info(f"Replaying audio from {source}")
+            source = WavSource(source, realtime=realtime)
+        elif enabled:
+            if self.mic_index is None:
+                log.info("No mic index provided, using default")
+            source = sr.Microphone(sample_rate=16000, device_index=self.mic_index)
+        # None when only transcribing given audio (e.g. in benchmarks)
+        self.source = MeteredSource(source, self.on_level) if source is not None else None
+
+        # Level meter, updated at most meter_fps times per second and only
+        # when something changed. The PNG feed is only rendered while
+        # someone watches it.
+        self.level = 0.0
+        self.meter_fps = 10
+        self.meter = Broadcast()
+        self.meter_frames = Broadcast()
+        self._meter_clients = 0
+        self._meter_thread = None
+        self._meter_lock = threading.Lock()
+        self._status_key = None
+        self._status_img = None
 
         self.recorder = sr.Recognizer()
         self.recorder.energy_threshold = self.energy
         self.recorder.pause_threshold = self.pause
         self.recorder.dynamic_energy_threshold = self.dynamic_energy
 
-        if not enabled:
+        if not lazy:
+            self.load()
+
+    def load(self):
+        """Loads the Whisper model and, if enabled, starts listening"""
+        log.info(f'Loading Whisper model {self.model}')
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        self.audio_model = whisper.load_model(
+            self.model, download_root=self.model_root).to(self.device)
+        if self.quantize:
+            if self.gpu:
+                log.warning('Quantization is only supported on the CPU, skipping')
+            else:
+                self.audio_model = quantize_model(self.audio_model)
+
+        if not self.enabled:
             return
 
-        with self.source:
-            self.recorder.adjust_for_ambient_noise(self.source)
+        if isinstance(self.source.source, sr.Microphone):
+            with self.source:
+                self.recorder.adjust_for_ambient_noise(self.source)
 
-        self.recorder.listen_in_background(
-            self.source, self.record_callback, phrase_time_limit=2
-        )
+        if self.streaming:
+            self.listener = threading.Thread(target=self.listen_forever, daemon=True)
+            self.listener.start()
+        else:
+            self.recorder.listen_in_background(
+                self.source, self.record_callback, phrase_time_limit=2
+            )
 
         self.start()
     
     def start(self):
-        self.thread = threading.Thread(target=self.transcribe_forever)
+        target = self.transcribe_streaming_forever if self.streaming else self.transcribe_forever
+        self.thread = threading.Thread(target=target)
         self.thread.start()
         log.info("Transcribing, you can now talk")
     
@@ -119,28 +398,40 @@ class MicrophoneStreaming:
         self.islocked = False
 
     def preprocess(self, data):
+        # Audio from the ring is already float32, so this does not copy it
+        if isinstance(data, np.ndarray) and data.dtype == np.float32:
+            return torch.from_numpy(data)
         return torch.from_numpy(
             np.frombuffer(data, np.int16).flatten().astype(np.float32) / 32768.0
         )
 
-    def get_all_audio(self, min_time: float = -1.0):
-        audio = bytes()
-        got_audio = False
+    def get_all_audio(self, min_time: float = -1.0, timeout: float = 1.0):
+        """
+        Blocks until audio was recorded (or timeout, then returns None) and
+        waits at least min_time seconds to collect more.
+        """
+        if self.paced and not self.streaming:
+            try:
+                return self.phrases.get(timeout=timeout)
+            except queue.Empty:
+                return None
         time_start = time.time()
-        while not got_audio or time.time() - time_start < min_time:
-            while not self.audio_queue.empty():
-                audio += self.audio_queue.get()
-                got_audio = True
-
-        data = sr.AudioData(audio, 16000, 2)
-        data = data.get_raw_data()
-        return data
+        if not self.audio_ring.wait(timeout):
+            return None
+        remaining = min_time - (time.time() - time_start)
+        if remaining > 0:
+            time.sleep(remaining)
+        return self.audio_ring.read()
 
     def record_callback(self, _, audio: sr.AudioData) -> None:
         # check if locked
-        if not self.locked():
-            data = audio.get_raw_data()
-            self.audio_queue.put_nowait(data)
+        if self.locked():
+            return
+        if self.paced:
+            # Wait for the transcriber, one phrase at a time
+            self.phrases.put(audio.get_raw_data())
+        else:
+            self.audio_ring.write(audio.get_raw_data())
 
     def transcribe_forever(self) -> None:
         while getattr(threading.current_thread(), "transcribe", True):
@@ -150,19 +441,130 @@ class MicrophoneStreaming:
                 log.error(e)
         log.debug(f'ended transcription loop')
 
-    def transcribe(self, data=None, realtime: bool = False) -> None:
-        if data is None:
-            audio_data = self.get_all_audio()
-        else:
-            audio_data = data
+    def listen_forever(self) -> None:
+        """Records continuously into the ring buffer (streaming mode)"""
+        with self.source:
+            while getattr(threading.current_thread(), "listen", True):
+                buffer = self.source.stream.read(self.source.CHUNK)
+                if not self.locked():
+                    self.audio_ring.write(buffer)
+
+    def is_speech(self, frame: np.ndarray) -> bool:
+        # Same energy scale as the recognizer's (RMS of int16 samples)
+        rms = np.sqrt(np.mean(np.square(frame, dtype=np.float64))) * 32768
+        return rms > self.recorder.energy_threshold
+
+    def transcribe_streaming_forever(self) -> None:
+        rate = self.audio_ring.sample_rate
+        frame_len = int(0.03 * rate) # 30 ms VAD frames
+        preroll = np.zeros(0, np.float32) # kept to not cut off the first sound
+        utterance = [] # float32 chunks of the current utterance
+        pending = np.zeros(0, np.float32)
+        speech_start = speech_end = last_partial = None
+        audio_time = 0.0 # seconds of audio processed, the clock of a paced replay
+
+        while getattr(threading.current_thread(), "transcribe", True):
+            try:
+                audio = self.get_all_audio(timeout=0.1)
+                if audio is not None:
+                    pending = np.concatenate([pending, audio])
+                n_frames = len(pending) // frame_len
+                frames = pending[:n_frames * frame_len].reshape(n_frames, frame_len)
+                pending = pending[n_frames * frame_len:]
+
+                read_time = time.time()
+                for i, frame in enumerate(frames):
+                    if self.paced:
+                        # Replayed audio comes faster than real time, so
+                        # pauses are measured in audio time
+                        audio_time += frame_len / rate
+                        now = audio_time
+                    else:
+                        # When the frame was recorded, as a decode can take
+                        # longer than a pause and frames pile up meanwhile
+                        now = read_time - (n_frames - 1 - i) * frame_len / rate
+                    if self.is_speech(frame):
+                        if speech_start is None:
+                            speech_start = last_partial = now
+                            utterance = [preroll]
+                            self.latency['first_partial'] = None
+                        speech_end = None
+                    elif speech_start is not None and speech_end is None:
+                        speech_end = now
+                    if speech_start is None:
+                        preroll = np.concatenate([preroll, frame])[-int(0.3 * rate):]
+                        continue
+                    utterance.append(frame.copy())
+
+                    # At the very frame the pause or the length limit is
+                    # reached, so speech after it starts a new utterance
+                    length = sum(len(c) for c in utterance) / rate
+                    paused = speech_end is not None and now - speech_end >= self.pause
+                    if paused or length >= self.max_utterance:
+                        self.final(np.concatenate(utterance),
+                                   None if self.paced else speech_end)
+                        speech_start = speech_end = None
+                        preroll = np.zeros(0, np.float32)
+
+                if speech_start is None:
+                    continue
+                now = audio_time if self.paced else time.time()
+                if now - last_partial >= self.partial_interval:
+                    window = np.concatenate(utterance)[-int(self.partial_window * rate):]
+                    self.partial = self.decode(window)['text'].strip()
+                    last_partial = now if self.paced else time.time()
+                    if self.latency['first_partial'] is None:
+                        self.latency['first_partial'] = last_partial - speech_start
+                        log.info(f"First partial '{self.partial}' after "
+                                 f"{self.latency['first_partial']:.2f}s")
+                    else:
+                        log.debug(f"Partial '{self.partial}'")
+            except Exception as e:
+                log.error(e)
+        log.debug('ended streaming transcription loop')
+
+    def final(self, utterance, speech_end=None):
+        """
+        Transcribes a whole utterance; the latency is counted from
+        speech_end, or from the start of the decode without it
+        """
+        decode_start = time.time()
+        result = self.transcribe(data=utterance)
+        self.latency['final'] = time.time() - (speech_end or decode_start)
+        log.info(f"Final '{result['text'].strip()}' after "
+                 f"{self.latency['final']:.2f}s")
+        self.partial = ''
+
+    def stats(self):
+        return {
+            'streaming': self.streaming,
+            'partial': self.partial,
+            'time_to_first_partial': self.latency['first_partial'],
+            'time_to_final': self.latency['final'],
+            'dropped_samples': self.audio_ring.dropped,
+        }
+
+    def decode(self, audio_data):
         audio_data = self.preprocess(audio_data)
         if self.english:
-            result = self.audio_model.transcribe(audio_data, fp16=self.gpu, language="english")
+            result = self.audio_model.transcribe(audio_data, fp16=self.gpu, language="english",
+                                                 **self.decode_options)
         else:
-            result = self.audio_model.transcribe(audio_data, fp16=self.gpu)
+            result = self.audio_model.transcribe(audio_data, fp16=self.gpu,
+                                                 **self.decode_options)
         
         # remove repeated substrings
         result['text'] = re.sub(r"(.+?)\1+", r"\1", result['text'])
+        return result
+
+    def transcribe(self, data=None, realtime: bool = False, emit: bool = True):
+        if data is None:
+            audio_data = self.get_all_audio()
+            if audio_data is None:
+                return
+        else:
+            audio_data = data
+        result = self.decode(audio_data)
 
         if result['text'] not in self.empty_results:
             now = datetime.now()
@@ -187,56 +589,111 @@ class MicrophoneStreaming:
                             f"prob: no_speech={no:.2f}, ok={ok:.2f}; "
                             f"ok diff: text={text_diff}, time={time_diff}; ")
             
-            if (not any_no_speech) and all_ok_speech and text_new:
+            if (not any_no_speech) and all_ok_speech and text_new and emit:
                 self.last_ok_text_time = (text, datetime.now())
                 State.input('HEAR', text)
+        return result
 
-    def show(self):
-        source = sr.Microphone(sample_rate=16000, device_index=self.mic_index)
+    def on_level(self, energy) -> None:
+        self.level = min(1, max(0, energy / 5000))
+
+    def status(self):
+        """Level and last transcription, as shown by the meter"""
+        status = {'level': round(self.level, 2), 'locked': self.locked()}
+        result, last_time = self.last_result_time
+        if result:
+            segs = result['segments']
+            ok_prob = min([math.exp(s['avg_logprob']) for s in segs], default=0)
+            no_prob = max([s['no_speech_prob'] for s in segs], default=1)
+            status.update({
+                'time': f'{last_time:%H:%M:%S}',
+                'text': result['text'],
+                'ok_prob': round(ok_prob, 2),
+                'no_prob': round(no_prob, 2),
+                'ok': ok_prob > self.ok_speech_threshold,
+                'no': no_prob < self.no_speech_threshold,
+            })
+        return status
+
+    def start_meter(self):
+        with self._meter_lock:
+            if self._meter_thread is None:
+                self._meter_thread = threading.Thread(target=self.meter_forever, daemon=True)
+                self._meter_thread.start()
+
+    def meter_forever(self):
+        last = rendered = None
         while True:
             try:
-                with source:
-                    buffer = source.stream.read(source.CHUNK)
-                    energy = audioop.rms(buffer, source.SAMPLE_WIDTH)
-                    rel = min(1, max(0, energy / 5000))
-                    
-                    w, h = MIC_IMG.size
-                    im = Image.new("RGBA", (400,h))
-
-                    # Draw microphone level
-                    draw = ImageDraw.Draw(im)
-                    draw.rectangle(((0, 0), (w-1, h)), fill=(0, 0, 0))
-                    size = (h / 1.5) - int((h / 1.5) * rel)
-                    color = (255, 0, 0) if self.locked() else (0, 128, 0)
-                    draw.rectangle(((0, size), (w-1, h)), fill=color)
-                    im.paste(MIC_IMG, mask=MIC_IMG)
-
-                    # Draw last status
-                    font = ImageFont.load_default()
-                    result, last_time = self.last_result_time
-                    if result:
-                        time_str = f'{last_time:%H:%M:%S}'
-                        draw.text((w+10, 6), time_str, font=font, fill=(0, 0, 0, 128))
-                        text = result['text']
-                        segs = result['segments']
-                        draw.text((w+10, 24), text, font=font, fill=(0, 0, 0))
-                        ok_prob = min([math.exp(s['avg_logprob']) for s in segs])
-                        no_prob = max([s['no_speech_prob'] for s in segs])
-                        ok = (ok_prob > self.ok_speech_threshold)
-                        no = (no_prob < self.no_speech_threshold)
-                        pcol = lambda x: (0, 128, 0) if x else (255, 0, 0)
-                        ok_str = f'p(ok speech)={ok_prob:.2f}'
-                        no_str = f'p(no speech)={no_prob:.2f}'
-                        draw.text((w+10, 42), ok_str, font=font, fill=pcol(ok))
-                        draw.text((w+150, 42), no_str, font=font, fill=pcol(no))
-                    
-
-                    arr = io.BytesIO()
-                    im.save(arr, format="png")
-                    frame = arr.getvalue()
-                    yield (
-                        b"--frame\r\n" b"Content-Type: image/png\r\n\r\n" + frame + b"\r\n"
-                    )
+                status = self.status()
+                if status != last:
+                    self.meter.publish(status)
+                    last = status
+                if self._meter_clients and status != rendered:
+                    self.meter_frames.publish(self.render_meter(status))
+                    rendered = status
             except Exception as e:
                 log.error(e)
-            time.sleep(0.01)
+            time.sleep(1 / self.meter_fps)
+
+    def render_status(self, status):
+        """The static part of the meter, redrawn only when the result changes"""
+        key = tuple(status.get(k) for k in ('time', 'text', 'ok_prob', 'no_prob'))
+        if key != self._status_key:
+            w, h = MIC_IMG.size
+            im = Image.new("RGBA", (400,h))
+            draw = ImageDraw.Draw(im)
+            font = ImageFont.load_default()
+            if 'text' in status:
+                draw.text((w+10, 6), status['time'], font=font, fill=(0, 0, 0, 128))
+                draw.text((w+10, 24), status['text'], font=font, fill=(0, 0, 0))
+                pcol = lambda x: (0, 128, 0) if x else (255, 0, 0)
+                ok_str = f'p(ok speech)={status["ok_prob"]:.2f}'
+                no_str = f'p(no speech)={status["no_prob"]:.2f}'
+                draw.text((w+10, 42), ok_str, font=font, fill=pcol(status['ok']))
+                draw.text((w+150, 42), no_str, font=font, fill=pcol(status['no']))
+            self._status_key, self._status_img = key, im
+        return self._status_img
+
+    def render_meter(self, status):
+        im = self.render_status(status).copy()
+        w, h = MIC_IMG.size
+
+        # Draw microphone level
+        draw = ImageDraw.Draw(im)
+        draw.rectangle(((0, 0), (w-1, h)), fill=(0, 0, 0))
+        size = (h / 1.5) - int((h / 1.5) * status['level'])
+        color = (255, 0, 0) if status['locked'] else (0, 128, 0)
+        draw.rectangle(((0, size), (w-1, h)), fill=color)
+        im.paste(MIC_IMG, mask=MIC_IMG)
+
+        arr = io.BytesIO()
+        im.save(arr, format="png")
+        frame = arr.getvalue()
+        return b"--frame\r\n" b"Content-Type: image/png\r\n\r\n" + frame + b"\r\n"
+
+    def levels(self, keepalive=15):
+        """
+        Yields the meter status whenever it changes, and None after
+        keepalive seconds without a change (e.g. with the mic disabled)
+        """
+        self.start_meter()
+        seq = 0
+        while True:
+            new_seq, status = self.meter.wait(seq, timeout=keepalive)
+            if new_seq == seq or status is None:
+                yield None
+                continue
+            seq = new_seq
+            yield status
+
+    def show(self):
+        """PNG meter feed, for browsers that cannot render the levels"""
+        self.start_meter()
+        with self._meter_lock:
+            self._meter_clients += 1
+        try:
+            yield from self.meter_frames.subscribe(timeout=1, resend=1)
+        finally:
+            with self._meter_lock:
+                self._meter_clients -= 1
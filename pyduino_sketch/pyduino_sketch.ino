@@ -7,16 +7,25 @@
  * - RA4 - > Reads the Analog input at pin 4
  * - WD13:1 -> Writes 1 (HIGH) to digital output pin 13
  * - WA6:125 -> Writes 125 to analog output pin 6 (PWM)
+ * - MO13 -> Sets pin 13 to OUTPUT (I for INPUT, P for INPUT_PULLUP)
+ * - BD12,A0,A1 -> Reads several pins at once, replies BD12:1,A0:512,A1:3
+ * - S100,D12,A0 -> Sends SD12:1,A0:512 every 100 ms until S0
+ *
+ * Commands end with a newline, so several can be sent without waiting for
+ * the replies.
  */
 
+#define BAUD_RATE 115200 // Must match the baud_rate of the Arduino class
+#define MAX_PINS 16 // Pins in a batch read or subscription
+
+char command[96]; // Holds the command being received
+int command_length = 0;
 
-char operation; // Holds operation (R, W, ...)
-char mode; // Holds the mode (D, A)
-int pin_number; // Holds the pin number
-int digital_value; // Holds the digital value
-int analog_value; // Holds the analog value
-int value_to_write; // Holds the value that we want to write
-int wait_for_transmission = 5; // Delay in ms in order to receive the serial data
+char subscribed_modes[MAX_PINS]; // D or A, per subscribed pin
+int subscribed_pins[MAX_PINS];
+int subscribed_count = 0;
+unsigned long subscribe_interval = 0; // In ms, 0 when not subscribed
+unsigned long last_sample = 0;
 
 void set_pin_mode(int pin_number, char mode){
     /*
@@ -46,11 +55,10 @@ void digital_read(int pin_number){
      * in this format: D{pin_number}:{value}\n where value can be 0 or 1
      */
 
-    digital_value = digitalRead(pin_number);
     Serial.print('D');
     Serial.print(pin_number);
     Serial.print(':');
-    Serial.println(digital_value); // Adds a trailing \n
+    Serial.println(digitalRead(pin_number)); // Adds a trailing \n
 }
 
 void analog_read(int pin_number){
@@ -59,11 +67,10 @@ void analog_read(int pin_number){
      * in this format: A{pin_number}:{value}\n where value ranges from 0 to 1023
      */
 
-    analog_value = analogRead(pin_number);
     Serial.print('A');
     Serial.print(pin_number);
     Serial.print(':');
-    Serial.println(analog_value); // Adds a trailing \n
+    Serial.println(analogRead(pin_number)); // Adds a trailing \n
 }
 
 void digital_write(int pin_number, int digital_value){
@@ -82,50 +89,114 @@ void analog_write(int pin_number, int analog_value){
 	analogWrite(pin_number, analog_value);
 }
 
+int parse_pins(char *list, char *modes, int *pins){
+    /*
+     * Parses a list of pins like D12,A0,A1 into modes and pin numbers and
+     * returns how many there are
+     */
+
+    int count = 0;
+    char *token = strtok(list, ",");
+    while (token != NULL && count < MAX_PINS){
+        if (token[0] == 'D' || token[0] == 'A'){
+            modes[count] = token[0];
+            pins[count] = atoi(token + 1);
+            count++;
+        }
+        token = strtok(NULL, ",");
+    }
+    return count;
+}
+
+void read_pins(char prefix, char *modes, int *pins, int count){
+    /*
+     * Reads several pins and returns the values to serial in one line, e.g.
+     * BD12:1,A0:512\n
+     */
+
+    Serial.print(prefix);
+    for (int i = 0; i < count; i++){
+        if (i > 0){
+            Serial.print(',');
+        }
+        Serial.print(modes[i]);
+        Serial.print(pins[i]);
+        Serial.print(':');
+        Serial.print(modes[i] == 'D' ? digitalRead(pins[i]) : analogRead(pins[i]));
+    }
+    Serial.println();
+}
+
+void handle_command(char *command){
+    char operation = command[0]; // R, W, M, B or S
+    char mode = command[1]; // D, A or the pin mode
+    int pin_number = atoi(command + 2);
+    char *value = strchr(command, ':');
+    int value_to_write = value ? atoi(value + 1) : 0;
+    char modes[MAX_PINS];
+    int pins[MAX_PINS];
+
+    switch (operation){
+        case 'R': // Read operation, e.g. RD12, RA4
+            if (mode == 'D'){ // Digital read
+                digital_read(pin_number);
+            } else if (mode == 'A'){ // Analog read
+                analog_read(pin_number);
+            }
+            break;
+
+        case 'W': // Write operation, e.g. WD3:1, WA8:255
+            if (mode == 'D'){ // Digital write
+                digital_write(pin_number, value_to_write);
+            } else if (mode == 'A'){ // Analog write
+                analog_write(pin_number, value_to_write);
+            }
+            break;
+
+        case 'M': // Pin mode, e.g. MI3, MO3, MP3
+            set_pin_mode(pin_number, mode); // Mode contains I, O or P (INPUT, OUTPUT or PULLUP_INPUT)
+            break;
+
+        case 'B': // Batch read, e.g. BD12,A0,A1
+            read_pins('B', modes, pins, parse_pins(command + 1, modes, pins));
+            break;
+
+        case 'S': // Subscribe, e.g. S100,D12,A0 or S0 to stop
+            subscribe_interval = atol(command + 1);
+            value = strchr(command, ',');
+            subscribed_count = value ? parse_pins(value + 1, subscribed_modes, subscribed_pins) : 0;
+            last_sample = millis();
+            break;
+
+        default: // Unexpected char
+            break;
+    }
+}
+
 void setup() {
-    Serial.begin(9600); // Serial Port at 9600 baud
-    Serial.setTimeout(100); // Instead of the default 1000ms, in order
-                            // to speed up the Serial.parseInt() 
+    Serial.begin(BAUD_RATE);
 }
 
 
 void loop() {
-    // Check if characters available in the buffer
-    if (Serial.available() > 0) {
-        operation = Serial.read();
-        delay(wait_for_transmission); // If not delayed, second character is not correctly read
-        mode = Serial.read();
-        pin_number = Serial.parseInt(); // Waits for an int to be transmitted
-        if (Serial.read()==':'){
-            value_to_write = Serial.parseInt(); // Collects the value to be written
-        }
-        switch (operation){
-            case 'R': // Read operation, e.g. RD12, RA4
-                if (mode == 'D'){ // Digital read
-                    digital_read(pin_number);
-                } else if (mode == 'A'){ // Analog read
-                    analog_read(pin_number);
-				} else {
-					break; // Unexpected mode
-				}
-                break;
-
-            case 'W': // Write operation, e.g. WD3:1, WA8:255
-                if (mode == 'D'){ // Digital write
-                    digital_write(pin_number, value_to_write);
-                } else if (mode == 'A'){ // Analog write
-                    analog_write(pin_number, value_to_write);
-                } else {
-                    break; // Unexpected mode
-                }
-                break;
-
-            case 'M': // Pin mode, e.g. MI3, MO3, MP3
-                set_pin_mode(pin_number, mode); // Mode contains I, O or P (INPUT, OUTPUT or PULLUP_INPUT)
-                break;
-
-            default: // Unexpected char
-                break;
+    // Collect characters until the end of a command
+    while (Serial.available() > 0) {
+        char c = Serial.read();
+        if (c == '\n' || c == '\r'){
+            if (command_length > 0){
+                command[command_length] = '\0';
+                handle_command(command);
+                command_length = 0;
+            }
+        } else if (command_length < (int) sizeof(command) - 1){
+            command[command_length++] = c;
         }
     }
+
+    // Stream the subscribed pins
+    if (subscribe_interval > 0 && subscribed_count > 0
+            && millis() - last_sample >= subscribe_interval){
+        last_sample = millis();
+        read_pins('S', subscribed_modes, subscribed_pins, subscribed_count);
+    }
 }
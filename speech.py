@@ -1,29 +1,56 @@
 import rlvoice
 import logging
+import queue
+import threading
 import time
 
 log = logging.getLogger(__name__)
 
 class SpeechProduction:
-    def __init__(self, audio=None, rate=None, enabled=True, **kwargs):
+    def __init__(self, audio=None, rate=None, enabled=True, lazy=False, **kwargs):
         self.audio = audio
         self.enabled = enabled
+        self.rate = rate
+        self.kwargs = kwargs
+        self.engine = None
+        # Utterances are spoken one after another by a worker thread, so
+        # whoever asks to speak (e.g. the event dispatcher) doesn't wait
+        self.utterances = queue.Queue()
+        self._thread = None
 
+        if not lazy:
+            self.load()
+
+    def load(self):
         if self.enabled:
             log.info('Loading text-to-speech...')
-            self.engine = rlvoice.init(**kwargs)
-            if rate:
-                self.engine.setProperty('rate', rate)
+            self.engine = rlvoice.init(**self.kwargs)
+            if self.rate:
+                self.engine.setProperty('rate', self.rate)
             log.info(f'Text-to-speech loaded: {self.engine.getProperty("voice")}')
     
     def speak(self, text):
-        if self.enabled:
-            if self.audio:
-                self.audio.lock()
-                time.sleep(0.5)
-            log.debug(f'Saying {text}')
-            self.engine.say(text)
-            self.engine.runAndWait()
-            if self.audio:
-                time.sleep(0.5)
-                self.audio.unlock()
\ No newline at end of file
+        if self.enabled and self.engine:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.speak_forever, daemon=True)
+                self._thread.start()
+            self.utterances.put(text)
+
+    def speak_forever(self):
+        while True:
+            text = self.utterances.get()
+            try:
+                self.say(text)
+            except Exception as e:
+                log.exception(e)
+
+    def say(self, text):
+        if self.audio:
+            self.audio.lock()
+            time.sleep(0.5)
+        log.debug(f'Saying {text}')
+        self.engine.say(text)
+        self.engine.runAndWait()
+        if self.audio:
+            time.sleep(0.5)
+            self.audio.unlock()
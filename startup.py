@@ -0,0 +1,56 @@
+"""
+Keeps track of how far the application is with starting up: which
+subsystems are still loading in the background, and when milestones such
+as the first page or the first detection were reached.
+"""
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+START_TIME = time.time()
+
+_status = {} # subsystem -> 'loading', 'ready' or 'failed'
+_load_times = {}
+_milestones = {}
+_lock = threading.Lock()
+
+
+def load(name, loader):
+    """Runs loader() in a background thread and tracks its status as name"""
+    def run():
+        start = time.time()
+        try:
+            loader()
+        except Exception as e:
+            log.exception(e)
+            _status[name] = 'failed'
+            return
+        _load_times[name] = round(time.time() - start, 3)
+        _status[name] = 'ready'
+        log.info(f'{name} loaded in {_load_times[name]:.2f}s')
+
+    _status[name] = 'loading'
+    thread = threading.Thread(target=run, name=f'load-{name}', daemon=True)
+    thread.start()
+    return thread
+
+
+def mark(milestone):
+    """Logs the time since startup the first time a milestone is reached"""
+    if milestone in _milestones:
+        return
+    with _lock:
+        if milestone not in _milestones:
+            _milestones[milestone] = round(time.time() - START_TIME, 3)
+            log.info(f'Time to {milestone}: {_milestones[milestone]:.2f}s')
+
+
+def status():
+    return {
+        'subsystems': dict(_status),
+        'load_times': dict(_load_times),
+        'milestones': dict(_milestones),
+        'uptime': round(time.time() - START_TIME, 3),
+    }
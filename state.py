@@ -1,39 +1,120 @@
+import atexit
+import os
+import threading
+import time
+
 import requests
 
 class State:
-    def __init__(self, fname):
+    # In-process EventBus for input and output messages; without one they
+    # are posted to the web server
+    bus = None
+
+    def __init__(self, fname, flush_interval=1.0):
         self.fname = fname
         self.actions = {}
 
+        # The log is kept in memory, indexed by sequence number (the first
+        # message has seq 1), and mirrored to the append-only file. Writes
+        # to the file are flushed in the background every flush_interval
+        # seconds, and on exit. Sequence numbers keep increasing when the log
+        # is cleared; offset is the number of messages cleared so far.
+        self.messages = []
+        if os.path.exists(fname):
+            self.messages = open(fname, encoding='utf-8').read().splitlines()
+        self.offset = 0
+        self.cond = threading.Condition()
+        self.flush_interval = flush_interval
+        self._file = open(fname, 'a', encoding='utf-8')
+        self._dirty = False
+        atexit.register(self.flush)
+        threading.Thread(target=self.flush_forever, daemon=True).start()
+
     def register_action(self, keyword, action):
         self.actions.setdefault(keyword, []).append(action)
-    
-    def read(self):
-        return open(self.fname, encoding='utf-8').read()
+
+    @property
+    def seq(self):
+        """Sequence number of the last message"""
+        return self.offset + len(self.messages)
+
+    def lines(self, since=0, last=None, until=None):
+        """
+        Messages after sequence number since (up to and including until),
+        or only the last ones of those
+        """
+        with self.cond:
+            since = max(since - self.offset, 0)
+            if until is not None:
+                until = max(until - self.offset, 0)
+            lines = self.messages[since:until]
+        if last is not None:
+            lines = lines[-last:] if last > 0 else []
+        return lines
+
+    def read(self, since=0, last=None, until=None):
+        return ''.join(f'{line}\n' for line in self.lines(since, last, until))
+
+    def wait(self, since, timeout=None):
+        """
+        Blocks until there are messages after sequence number since (or
+        timeout) and returns the current sequence number
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > since, timeout)
+            return self.seq
 
     def log(self, message):
+        """Logs a message, does its actions and returns its sequence number"""
         # Write to log
-        with open(self.fname, 'a', encoding='utf-8') as fw:
-            print(message, file=fw)
-        
+        with self.cond:
+            self.messages.extend(message.splitlines() or [''])
+            seq = self.seq
+            print(message, file=self._file)
+            self._dirty = True
+            self.cond.notify_all()
+
         # Do action
         if ' ' in message:
             keyword, content = message.split(' ', 1)
         else:
             keyword, content = '', message
-        if keyword[0] == '>':
-            for action in self.actions.get(keyword[1:]):
+        if keyword[:1] == '>':
+            for action in self.actions.get(keyword[1:], []):
                 action(content)
+        return seq
+
+    def flush(self):
+        with self.cond:
+            if self._dirty:
+                self._file.flush()
+                self._dirty = False
+
+    def flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
 
     def clear(self):
-        open(self.fname, 'w').close()
+        with self.cond:
+            self.offset += len(self.messages)
+            self.messages = []
+            self._dirty = False
+            self._file.close()
+            open(self.fname, 'w').close()
+            self._file = open(self.fname, 'a', encoding='utf-8')
 
     @staticmethod
-    def input(keyword, content):
-        message = f'<{keyword} {content}'
-        requests.post('http://127.0.0.1:5000/state', data=message.encode('utf8'))
-    
+    def send(message, timestamp=None):
+        if State.bus is not None:
+            State.bus.publish(message, timestamp)
+        else:
+            requests.post('http://127.0.0.1:5000/state', data=message.encode('utf8'))
+
+    @staticmethod
+    def input(keyword, content, timestamp=None):
+        State.send(f'<{keyword} {content}', timestamp)
+
     @staticmethod
-    def output(keyword, content):
-        message = f'>{keyword} {content}'
-        requests.post('http://127.0.0.1:5000/state', data=message.encode('utf8'))
\ No newline at end of file
+    def output(keyword, content, timestamp=None):
+        State.send(f'>{keyword} {content}', timestamp)
@@ -1,19 +1,103 @@
+// State messages are pushed by the server (Server-Sent Events) and only new
+// rows are appended; polling with ?since= is the fallback
+let state_seq = 0;
+
+function add_state(lines) {
+  const el = document.getElementById('state');
+  for (const s of lines) {
+    if (!s) continue;
+    const row = document.createElement('div');
+    row.className = (s[0] == '<') ? 'q' : 'a';
+    row.textContent = s.slice(1);
+    el.appendChild(row);
+  }
+  const box = el.parentElement.parentElement;
+  box.scrollTop = box.scrollHeight;
+}
+
+function clear_state() {
+  document.getElementById('state').replaceChildren();
+}
+
 function get_state() {
-  fetch('/state').then((response) => response.text())
-    .then((text) => {
-      el = document.getElementById('state')
-      html = text.split("\n").map((s) => 
-        s?`<div class="${s[0] == '<'? 'q' : 'a'}">${s.slice(1)}</div>`:''
-      ).join('\n');
-      el.innerHTML = html;
-      box = el.parentElement.parentElement;
-      box.scrollTop = box.scrollHeight;
-  })
-  setTimeout(function() {
+  fetch(`/state?since=${state_seq}`).then((response) => {
+    const seq = parseInt(response.headers.get('X-State-Seq'));
+    if (seq < state_seq) {
+      clear_state(); // The server restarted and sends everything again
+    }
+    state_seq = seq || state_seq;
+    return response.text();
+  }).then((text) => add_state(text.split("\n")))
+  .finally(() => {
+    // Only poll again once this request is done
+    setTimeout(get_state, 1000); // 1 second
+  });
+}
+
+function stream_state() {
+  if (!window.EventSource) {
+    return get_state();
+  }
+  let opened = false;
+  const source = new EventSource(`/state/stream?since=${state_seq}`);
+  source.onopen = function() { opened = true; };
+  source.onmessage = function(event) {
+    const seq = parseInt(event.lastEventId);
+    if (seq <= state_seq) {
+      clear_state(); // The server restarted and sends everything again
+    }
+    state_seq = seq || state_seq;
+    add_state([event.data]);
+  };
+  source.onerror = function() {
+    // Reconnecting is automatic, unless the stream never worked at all
+    if (!opened) {
+      source.close();
       get_state();
-  }, 1000); // 1 second
+    }
+  };
+}
+stream_state();
+
+
+
+// Microphone level, pushed by the server and drawn here; the PNG feed is
+// only used when Server-Sent Events do not work
+function audio_fallback() {
+  document.getElementById('audioMeter').style.display = 'none';
+  const img = document.getElementById('audioElement');
+  img.src = img.dataset.src;
+  img.style.display = '';
+}
+
+function audio_meter() {
+  if (!window.EventSource) {
+    return audio_fallback();
+  }
+  const source = new EventSource('/audio_level');
+  source.onmessage = function(event) {
+    const level = JSON.parse(event.data);
+    const bar = document.getElementById('audioBar');
+    bar.style.height = (100 - (1 - level.level) * 100 / 1.5) + '%';
+    bar.style.background = level.locked ? 'rgb(255, 0, 0)' : 'rgb(0, 128, 0)';
+    if (level.text !== undefined) {
+      const color = (x) => x ? 'rgb(0, 128, 0)' : 'rgb(255, 0, 0)';
+      document.getElementById('audioTime').textContent = level.time;
+      document.getElementById('audioText').textContent = level.text;
+      const ok = document.getElementById('audioOk');
+      ok.textContent = `p(ok speech)=${level.ok_prob.toFixed(2)}`;
+      ok.style.color = color(level.ok);
+      const no = document.getElementById('audioNo');
+      no.textContent = `p(no speech)=${level.no_prob.toFixed(2)}`;
+      no.style.color = color(level.no);
+    }
+  };
+  source.onerror = function() {
+    source.close();
+    audio_fallback();
+  };
 }
-get_state();
+audio_meter();
 
 
 
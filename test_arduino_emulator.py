@@ -0,0 +1,93 @@
+"""
+Tests of the Arduino class against the emulated board, so they run without
+hardware:
+
+    python -m pytest test_arduino_emulator.py
+"""
+import asyncio
+import time
+
+import pytest
+
+from arduino import Arduino
+
+
+@pytest.fixture
+def board():
+    board = Arduino(serial_port='emulator', read_timeout=1)
+    yield board
+    board.close()
+
+
+def test_write_and_read(board):
+    board.set_pin_mode(13, 'O')
+    board.digital_write(13, 1)
+    assert board.digital_read(13) == 1
+    board.digital_write(13, 0)
+    assert board.digital_read(13) == 0
+    board.conn.analog_inputs[4] = 512
+    assert board.analog_read(4) == 512
+    assert board.conn.pin_modes == {13: 'O'}
+
+
+def test_pipelined_reads(board):
+    for pin in range(6):
+        board.conn.analog_inputs[pin] = pin * 100
+    reads = [board.analog_read_nowait(pin) for pin in range(6)]
+    assert [read.result() for read in reads] == [0, 100, 200, 300, 400, 500]
+
+
+def test_async_read(board):
+    board.conn.digital_inputs[12] = 1
+    assert asyncio.run(board.digital_read_async(12)) == 1
+
+
+def test_read_pins(board):
+    board.conn.digital_inputs[12] = 1
+    board.conn.analog_inputs[0] = 42
+    values = board.read_pins(['D12', 'A0', 'A1'])
+    assert values == {'D12': 1, 'A0': 42, 'A1': 0}
+    assert board.latest('A0') == 42
+
+
+def test_subscribe(board):
+    board.conn.analog_inputs[0] = 1
+    board.subscribe(['D12', 'A0'], interval=20)
+    time.sleep(0.2)
+    assert board.latest('A0', max_age=0.1) == 1
+    assert board.latest('D12', max_age=0.1) == 0
+
+    board.conn.analog_inputs[0] = 2
+    time.sleep(0.2)
+    assert board.latest('A0', max_age=0.1) == 2
+
+    board.unsubscribe().result()
+    time.sleep(0.2)
+    assert board.latest('A0', max_age=0.1) is None
+
+
+def test_late_reply_is_dropped(board):
+    board.read_timeout = 0.2
+    board.conn.latency = 0.3
+    board.conn.analog_inputs[0] = 1
+    with pytest.raises(TimeoutError):
+        board.analog_read(0)
+    time.sleep(0.2) # the reply of 1 arrives late
+    board.conn.latency = 0
+    board.conn.analog_inputs[0] = 7
+    assert board.analog_read(0) == 7
+    assert board.stats()['timeouts'] == 1
+
+
+def test_cancelled_reads_free_their_slots(board):
+    board.conn.latency = 0.02
+
+    async def read_with_timeout():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(board.analog_read_async(0), 0.01)
+
+    for _ in range(10): # more than max_in_flight
+        asyncio.run(read_with_timeout())
+    board.conn.latency = 0
+    board.conn.analog_inputs[0] = 3
+    assert board.analog_read(0) == 3
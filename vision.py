@@ -1,5 +1,6 @@
 import os
 import time
+import threading
 import cv2
 import numpy as np
 import logging
@@ -7,15 +8,23 @@ from datetime import datetime
 import requests
 from tqdm import tqdm
 from urllib.parse import urlparse
+from collections import namedtuple
+from concurrent.futures import Future
 
 from camera_settings import check_settings, reset_settings
 from state import State
+from broadcast import Broadcast
+import startup
 
 
 log = logging.getLogger(__name__)
 
 FONT = cv2.FONT_HERSHEY_PLAIN
 
+# box is [x, y, w, h] in frame pixels, track_id is set by the Tracker
+Detection = namedtuple('Detection', ['box', 'confidence', 'class_id', 'track_id'],
+                       defaults=(None,))
+
 def download(url):
     fname = os.path.basename(urlparse(url).path)
     path = os.path.join("models", fname)
@@ -32,127 +41,787 @@ def download(url):
         progress_bar.close()
 
 
+def decode_outputs_loop(outs, width, height, threshold):
+    """
+    Reference decoding of YOLO output layers, one detection row at a time.
+    Returns lists of boxes [x, y, w, h], confidences and class ids.
+    """
+    class_ids = []
+    confidences = []
+    boxes = []
+    for out in outs:
+        for detection in out:
+            scores = detection[5:]
+            class_id = np.argmax(scores)
+            confidence = scores[class_id]
+            if confidence > threshold:
+                # * Object detected
+                center_x = int(detection[0]*width)
+                center_y = int(detection[1]*height)
+                w = int(detection[2]*width)
+                h = int(detection[3]*height)
+
+                # * Rectangle coordinates
+                x = int(center_x - w/2)
+                y = int(center_y - h/2)
+
+                boxes.append([x, y, w, h])
+                confidences.append(float(confidence))
+                class_ids.append(class_id)
+    return boxes, confidences, class_ids
+
+
+def decode_outputs(outs, width, height, threshold):
+    """
+    Vectorized version of decode_outputs_loop that returns exactly the same
+    boxes, confidences and class ids, using whole-array operations instead of
+    a Python loop over every row.
+    """
+    detections = np.concatenate([out.reshape(-1, out.shape[-1]) for out in outs])
+    scores = detections[:, 5:]
+    class_ids = np.argmax(scores, axis=1)
+    confidences = scores[np.arange(len(scores)), class_ids]
+
+    # The loop does its arithmetic on numpy scalars, whose result dtype can
+    # differ from array arithmetic (NumPy 1.x promotes to float64), so use
+    # the same dtypes here to get bit-identical boxes.
+    scalar = detections.dtype.type(1)
+    keep = confidences.astype((scalar * threshold).dtype) > threshold
+    detections, confidences, class_ids = (
+        detections[keep], confidences[keep], class_ids[keep])
+
+    xywh = detections[:, :4].astype((scalar * width).dtype)
+    center_x = (xywh[:, 0] * width).astype(int)
+    center_y = (xywh[:, 1] * height).astype(int)
+    w = (xywh[:, 2] * width).astype(int)
+    h = (xywh[:, 3] * height).astype(int)
+    x = (center_x - w/2).astype(int)
+    y = (center_y - h/2).astype(int)
+
+    boxes = np.stack([x, y, w, h], axis=1).tolist()
+    return boxes, confidences.astype(float).tolist(), class_ids.tolist()
+
+
+def load_face_cascade(face_model='haarcascade_frontalface_default.xml'):
+    # see also: https://github.com/opencv/opencv/tree/master/data/haarcascades
+    download(f'https://raw.githubusercontent.com/opencv/opencv/master/data/haarcascades/{face_model}')
+    return cv2.CascadeClassifier(os.path.join("models", face_model))
+
+
+class FaceDetector:
+    """
+    Haar cascade face detection on a downscaled copy of the frame (or of the
+    person boxes that were already found), with boxes scaled back to frame
+    pixels. The defaults match a plain detectMultiScale2(gray, 1.1, 4).
+    """
+
+    def __init__(self, cascade, scale=1.0, scale_factor=1.1, min_neighbors=4,
+                 min_size=None, in_persons=False, person_threshold=0.3):
+        self.cascade = cascade
+        self.scale = scale
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size # (w, h) in frame pixels
+        self.in_persons = in_persons
+        self.person_threshold = person_threshold
+
+    def regions(self, gray, persons):
+        height, width = gray.shape
+        boxes = [d.box for d in (persons or ()) if d.confidence >= self.person_threshold]
+        if not (self.in_persons and boxes):
+            return [(0, 0, width, height)]
+
+        regions = []
+        for x, y, w, h in boxes:
+            x1, y1 = max(0, x), max(0, y)
+            x2, y2 = min(width, x + w), min(height, y + h)
+            if x2 > x1 and y2 > y1:
+                regions.append((x1, y1, x2 - x1, y2 - y1))
+        # Not worth it when the person boxes cover more than the whole frame
+        if sum(w * h for _, _, w, h in regions) >= width * height:
+            return [(0, 0, width, height)]
+        return regions
+
+    def detect(self, gray, persons=None):
+        """Returns a list of ([x, y, w, h], confidence) of faces in gray"""
+        faces = []
+        for rx, ry, rw, rh in self.regions(gray, persons):
+            roi = gray[ry:ry + rh, rx:rx + rw]
+            if self.scale != 1.0:
+                size = (max(1, int(rw * self.scale)), max(1, int(rh * self.scale)))
+                roi = cv2.resize(roi, size, interpolation=cv2.INTER_AREA)
+            kwargs = {}
+            if self.min_size:
+                kwargs['minSize'] = tuple(max(1, int(v * self.scale)) for v in self.min_size)
+            boxes, neighbours = self.cascade.detectMultiScale2(
+                roi, self.scale_factor, self.min_neighbors, **kwargs)
+
+            for box, n in zip(boxes, neighbours):
+                box = [int(v / self.scale) for v in box]
+                box[0] += rx
+                box[1] += ry
+                # Overlapping person boxes can find the same face twice
+                if all(iou(box, other) < 0.5 for other, _ in faces):
+                    faces.append((box, n / 100))
+        return faces
+
+
+# OpenCV DNN backends and targets by name; not every build has all of them
+DNN_BACKENDS = {
+    'default': 'DNN_BACKEND_DEFAULT',
+    'opencv': 'DNN_BACKEND_OPENCV',
+    'openvino': 'DNN_BACKEND_INFERENCE_ENGINE',
+    'cuda': 'DNN_BACKEND_CUDA',
+}
+DNN_TARGETS = {
+    'cpu': 'DNN_TARGET_CPU',
+    'opencl': 'DNN_TARGET_OPENCL',
+    'opencl_fp16': 'DNN_TARGET_OPENCL_FP16',
+    'myriad': 'DNN_TARGET_MYRIAD',
+    'cuda': 'DNN_TARGET_CUDA',
+    'cuda_fp16': 'DNN_TARGET_CUDA_FP16',
+}
+# Darknet models with cfg and weights at pjreddie.com
+DNN_MODELS = ['yolov3-tiny', 'yolov3', 'yolov3-spp']
+
+
 class ObjectDetection:
-    def __init__(self, detect_faces = True, detect_objects = True, use_emojis=True, dnn_model = 'yolov3-tiny'):
+    def __init__(self, detect_faces = True, detect_objects = True, use_emojis=True, dnn_model = 'yolov3-tiny',
+                 face_settings=None, lazy=False, input_size=416, backend='default',
+                 target='cpu'):
         self.detect_objects = detect_objects
         self.detect_faces = detect_faces
         self.use_emojis = use_emojis
+        self.face_settings = face_settings or {}
 
-        check_settings()
         PROJECT_PATH = os.path.abspath(os.getcwd())
-        MODELS_PATH = os.path.join(PROJECT_PATH, "models")
-        
-        log.info(f'Loading DNN model {dnn_model}')
+        self.MODELS_PATH = os.path.join(PROJECT_PATH, "models")
+
         if not dnn_model:
             dnn_model = 'yolov3-tiny'
             print("no model specified, defaulting to 'yolov3-tiny'")
-
-        # see also https://github.com/pjreddie/darknet/tree/master/cfg
-        download(f"https://raw.githubusercontent.com/pjreddie/darknet/master/cfg/{dnn_model}.cfg")
-        download(f"https://pjreddie.com/media/files/{dnn_model}.weights")
-        self.MODEL = cv2.dnn.readNet(
-            os.path.join(MODELS_PATH, f"{dnn_model}.weights"),
-            os.path.join(MODELS_PATH, f"{dnn_model}.cfg"),
-        )
+        if dnn_model not in DNN_MODELS:
+            raise ValueError(f'Unknown DNN model {dnn_model}, expected one of {DNN_MODELS}')
+        self.dnn_model = dnn_model
+        if input_size % 32:
+            raise ValueError(f'DNN input size must be a multiple of 32, not {input_size}')
+        self.input_size = input_size # e.g. 320, 416 or 608
+        self.backend = backend
+        self.target = target
 
         self.CLASSES = []
-        with open(os.path.join(MODELS_PATH, "coco.names"), "r") as f:
+        with open(os.path.join(self.MODELS_PATH, "coco.names"), "r") as f:
             self.CLASSES = [line.strip() for line in f.readlines()]
         
         if self.use_emojis:
             self.EMOJIS = []
-            emoji_path = os.path.join(MODELS_PATH, "coco.emojis")
+            emoji_path = os.path.join(self.MODELS_PATH, "coco.emojis")
             with open(emoji_path, encoding='utf-8', errors='ignore') as f:
                 self.EMOJIS = [line.strip() for line in f.readlines()]
 
-        self.OUTPUT_LAYERS = [
-            self.MODEL.getLayerNames()[i - 1]
-            for i in self.MODEL.getUnconnectedOutLayers()
-        ]
         self.COLORS = np.random.uniform(0, 255, size=(len(self.CLASSES), 3))
         self.COLORS /= (np.sum(self.COLORS**2, axis=1) ** 0.5 / 255)[np.newaxis].T
 
-        face_model = 'haarcascade_frontalface_default.xml'
-        # see also: https://github.com/opencv/opencv/tree/master/data/haarcascades
-        download(f'https://raw.githubusercontent.com/opencv/opencv/master/data/haarcascades/{face_model}')
-        self.face_cascade = cv2.CascadeClassifier(os.path.join("models", face_model))
-
         self.last_seen_time = {}
+        self.seen_tracks = {} # (camera, track id) -> last time it was seen
+        # report is called from the capture thread of every camera
+        self.report_lock = threading.Lock()
 
-    def detectObj(self, snap, threshold=0.5):
-        height, width, channels = snap.shape
-        class_ids = []
-        confidences = []
-        boxes = []
+        # Set once the models are loaded; until then nothing is detected
+        self.loaded = threading.Event()
+        if not lazy:
+            self.load()
+
+    def load(self):
+        dnn_model = self.dnn_model
+        log.info(f'Loading DNN model {dnn_model}')
+        # see also https://github.com/pjreddie/darknet/tree/master/cfg
+        download(f"https://raw.githubusercontent.com/pjreddie/darknet/master/cfg/{dnn_model}.cfg")
+        download(f"https://pjreddie.com/media/files/{dnn_model}.weights")
+        self.MODEL = cv2.dnn.readNet(
+            os.path.join(self.MODELS_PATH, f"{dnn_model}.weights"),
+            os.path.join(self.MODELS_PATH, f"{dnn_model}.cfg"),
+        )
+        self.OUTPUT_LAYERS = [
+            self.MODEL.getLayerNames()[i - 1]
+            for i in self.MODEL.getUnconnectedOutLayers()
+        ]
+        self.set_backend(self.backend, self.target)
+
+        self.face_cascade = load_face_cascade()
+        self.faces = FaceDetector(self.face_cascade, **self.face_settings)
+        self.loaded.set()
+
+    def set_backend(self, backend='default', target='cpu'):
+        """
+        Selects the OpenCV DNN backend and target by name (see DNN_BACKENDS
+        and DNN_TARGETS), falling back to the default backend on the CPU if
+        this OpenCV build does not support them or the first forward pass
+        fails on them (which is where CUDA or OpenVINO problems show up).
+        """
+        backend_id = getattr(cv2.dnn, DNN_BACKENDS.get(backend, ''), None)
+        target_id = getattr(cv2.dnn, DNN_TARGETS.get(target, ''), None)
+        available = None
+        if backend_id is not None and hasattr(cv2.dnn, 'getAvailableTargets'):
+            available = list(cv2.dnn.getAvailableTargets(backend_id))
+        if (backend_id is None or target_id is None or
+                (available is not None and target_id not in available)):
+            log.warning(f'DNN backend {backend} with target {target} is not '
+                        f'available, using the default backend on the CPU')
+            backend, target = 'default', 'cpu'
+            backend_id, target_id = cv2.dnn.DNN_BACKEND_DEFAULT, cv2.dnn.DNN_TARGET_CPU
+        log.info(f'Using DNN backend {backend} with target {target}')
+        self.MODEL.setPreferableBackend(backend_id)
+        self.MODEL.setPreferableTarget(target_id)
+        self.backend, self.target = backend, target
+        try:
+            self.warm_up()
+        except cv2.error as e:
+            if (backend, target) == ('default', 'cpu'):
+                raise
+            log.warning(f'DNN backend {backend} with target {target} failed '
+                        f'({e}), using the default backend on the CPU')
+            self.set_backend('default', 'cpu')
+
+    def warm_up(self):
+        """Runs a forward pass on a blank frame, so the first frame isn't slow"""
+        blank = np.zeros((self.input_size, self.input_size, 3), np.uint8)
+        self.MODEL.setInput(cv2.dnn.blobFromImage(
+            blank, 1/255, (self.input_size, self.input_size), swapRB=True, crop=False))
+        self.MODEL.forward(self.OUTPUT_LAYERS)
+
+    def infer(self, snap, threshold=0.5):
+        """
+        Runs object (and face) detection on snap without side effects.
+        Returns a list of Detection tuples.
+        """
+        return self.infer_batch([snap], threshold)[0]
+
+    def infer_batch(self, snaps, threshold=0.5):
+        """
+        Like infer, but for several frames (e.g. of different cameras) with
+        a single forward pass. Returns a list of detections per frame.
+        """
+        batch = [[] for _ in snaps]
+        if not self.loaded.is_set():
+            return batch
 
         if self.detect_objects:
-            blob = cv2.dnn.blobFromImage(
-                snap, 1/255, (416, 416), swapRB=True, crop=False
+            blob = cv2.dnn.blobFromImages(
+                snaps, 1/255, (self.input_size, self.input_size), swapRB=True, crop=False
             )
             self.MODEL.setInput(blob)
             outs = self.MODEL.forward(self.OUTPUT_LAYERS)
 
-            # Showing informations on the screen
-            for out in outs:
-                for detection in out:
-                    scores = detection[5:]
-                    class_id = np.argmax(scores)
-                    confidence = scores[class_id]
-                    if confidence > threshold:
-                        # * Object detected
-                        center_x = int(detection[0]*width)
-                        center_y = int(detection[1]*height)
-                        w = int(detection[2]*width)
-                        h = int(detection[3]*height)
-
-                        # * Rectangle coordinates
-                        x = int(center_x - w/2)
-                        y = int(center_y - h/2)
-
-                        boxes.append([x, y, w, h])
-                        confidences.append(float(confidence))
-                        class_ids.append(class_id)
-        indexes = list(cv2.dnn.NMSBoxes(boxes, confidences, 0.5, 0.4))
+            for n, (snap, detections) in enumerate(zip(snaps, batch)):
+                height, width, channels = snap.shape
+                # Outputs only get a leading batch axis for more than one frame
+                frame_outs = [out[n] if out.ndim == 3 else out for out in outs]
+                boxes, confidences, class_ids = decode_outputs(
+                    frame_outs, width, height, threshold)
+                indexes = np.array(cv2.dnn.NMSBoxes(boxes, confidences, 0.5, 0.4))
+                for i in indexes.flatten():
+                    detections.append(
+                        Detection(boxes[i], confidences[i], class_ids[i]))
 
         if self.detect_faces:
-            gray = cv2.cvtColor(snap, cv2.COLOR_BGR2GRAY)
-            faces, face_confidences = self.face_cascade.detectMultiScale2(gray, 1.1, 4)
-            boxes += list(faces)
-            confidences += [i / 100 for i in face_confidences]
-            for _ in range(len(faces)):
-                class_ids.append(0) # class 0 = person
-                indexes.append(len(indexes)) # show boxes with last indexes
+            for snap, detections in zip(snaps, batch):
+                gray = cv2.cvtColor(snap, cv2.COLOR_BGR2GRAY)
+                persons = [d for d in detections if d.class_id == 0] # class 0 = person
+                for box, confidence in self.faces.detect(gray, persons):
+                    detections.append(Detection(box, confidence, 0))
 
+        startup.mark('first detection')
+        return batch
 
+    def label(self, detection):
+        if self.use_emojis:
+            return str(self.EMOJIS[detection.class_id])
+        return str(self.CLASSES[detection.class_id])
+
+    def report(self, detections, camera=None):
+        """
+        Sends a SEE input for things that were not seen in the last 5 seconds.
+        Tracked detections are only new when their track is, unless the same
+        kind of thing is already being tracked. With several cameras, things
+        are kept apart per camera and the input is tagged with its name.
+        """
         new_seen = set()
-        now = datetime.now()
-        for i in range(len(boxes)):
-            if i in indexes:
-                x, y, w, h = boxes[i]
-                label = str(self.CLASSES[class_ids[i]])
-                color = self.COLORS[i]
-                cv2.rectangle(snap, (x, y), (x + w, y + h), color, 2)
-                cv2.putText(snap, label, (x, y - 5), FONT, 2, color, 2)
-
+        with self.report_lock:
+            now = datetime.now()
+            tracked = {(camera, d.track_id): self.label(d) for d in detections
+                       if d.track_id is not None}
+            known = {seen for track, seen in tracked.items()
+                     if track in self.seen_tracks}
+            for track, seen in tracked.items():
+                if track not in self.seen_tracks and seen not in known:
+                    new_seen.add(seen)
+                self.seen_tracks[track] = now
+            # Forget tracks that are gone; the tracker retires them much sooner
+            for track, last in list(self.seen_tracks.items()):
+                if (now - last).seconds > 5:
+                    del self.seen_tracks[track]
+
+            for detection in detections:
+                if detection.track_id is not None:
+                    continue
                 # Keep track of last seen things
-                seen = label
-                if self.use_emojis:
-                    seen = str(self.EMOJIS[class_ids[i]])
-                last = self.last_seen_time.get(seen, None)
+                seen = self.label(detection)
+                last = self.last_seen_time.get((camera, seen), None)
                 if (not last) or (now - last).seconds > 5:
                     new_seen.add(seen)
-                self.last_seen_time[seen] = now
+                self.last_seen_time[(camera, seen)] = now
         if new_seen:
-            State.input('SEE', ', '.join(new_seen))
+            content = ', '.join(new_seen)
+            if camera is not None:
+                content += f' (camera {camera})'
+            State.input('SEE', content)
+
+    def detect(self, snap, threshold=0.5, camera=None):
+        detections = self.infer(snap, threshold)
+        self.report(detections, camera)
+        return detections
+
+    def draw(self, snap, detections):
+        for detection in detections:
+            x, y, w, h = detection.box
+            label = str(self.CLASSES[detection.class_id])
+            color = self.COLORS[detection.class_id]
+            cv2.rectangle(snap, (x, y), (x + w, y + h), color, 2)
+            cv2.putText(snap, label, (x, y - 5), FONT, 2, color, 2)
         return snap
 
+    def detectObj(self, snap, threshold=0.5):
+        return self.draw(snap, self.detect(snap, threshold))
+
+
+class MotionGate:
+    """
+    Cheap scene change check in front of ObjectDetection. Compares a small
+    blurred grayscale copy of each frame with the one of the last frame that
+    was passed through, and reports a change when more than `threshold` of
+    its pixels differ by more than `pixel_threshold` grey levels.
+    """
+
+    def __init__(self, threshold=0.01, pixel_threshold=25, width=64,
+                 max_skip=None, enabled=True):
+        self.threshold = threshold
+        self.pixel_threshold = pixel_threshold
+        self.width = width
+        self.max_skip = max_skip # force a pass after this many skipped frames
+        self.enabled = enabled
+
+        self.reference = None
+        self.change = 0.0
+        self.skipped = 0
+        self.passed = 0
+        self._skip_run = 0
+
+    def changed(self, snap):
+        if not self.enabled:
+            return True
+
+        height = max(1, snap.shape[0] * self.width // snap.shape[1])
+        small = cv2.resize(snap, (self.width, height), interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+        if self.reference is None or self.reference.shape != small.shape:
+            self.change = 1.0
+        else:
+            diff = cv2.absdiff(small, self.reference)
+            self.change = np.count_nonzero(diff > self.pixel_threshold) / diff.size
+
+        if (self.change >= self.threshold or
+                (self.max_skip is not None and self._skip_run >= self.max_skip)):
+            self.reference = small
+            self.passed += 1
+            self._skip_run = 0
+            return True
+        self.skipped += 1
+        self._skip_run += 1
+        return False
+
+    def stats(self):
+        return {
+            'gate_enabled': self.enabled,
+            'gate_change': round(self.change, 4),
+            'gate_passed': self.passed,
+            'gate_skipped': self.skipped,
+        }
+
+
+def iou(a, b):
+    """Intersection over union of two [x, y, w, h] boxes"""
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2 = min(a[0] + a[2], b[0] + b[2])
+    y2 = min(a[1] + a[3], b[1] + b[3])
+    inter = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+class Tracker:
+    """
+    Detect-then-track: runs full detection every `detect_every` frames, or
+    when no box could be tracked, and in between moves the boxes along with
+    the sparse optical flow of corner points inside them. A box without
+    enough points to follow stays where it is until the next detection.
+    Detections are matched to existing tracks by IoU so that tracks keep
+    stable ids.
+    """
+
+    def __init__(self, detect_every=10, iou_threshold=0.3, max_misses=2,
+                 min_points=3):
+        self.detect_every = detect_every
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses # detections a track may be missing from
+        self.min_points = min_points # tracked points needed to move a box
+
+        self.tracks = {} # track id -> [Detection, points, misses]
+        self.prev_gray = None
+        self.frames = 0
+        self.detections = 0
+        self.failures = 0
+        self.frozen = 0
+        self._next_id = 0
+
+    def update(self, snap, detect):
+        """
+        Returns the tracked detections in snap, calling detect(snap) for a
+        full detection when needed
+        """
+        gray = cv2.cvtColor(snap, cv2.COLOR_BGR2GRAY)
+        if (self.prev_gray is None or self.prev_gray.shape != gray.shape
+                or self.frames % self.detect_every == 0):
+            self.associate(gray, detect(snap))
+        elif not self.propagate(gray):
+            self.failures += 1
+            self.associate(gray, detect(snap))
+        self.prev_gray = gray
+        self.frames += 1
+        return [track[0] for track in self.tracks.values() if track[2] == 0]
+
+    def features(self, gray, box):
+        x, y, w, h = box
+        mask = np.zeros_like(gray)
+        mask[max(0, y):max(0, y + h), max(0, x):max(0, x + w)] = 255
+        return cv2.goodFeaturesToTrack(gray, maxCorners=20, qualityLevel=0.01,
+                                       minDistance=3, mask=mask)
+
+    def associate(self, gray, detections):
+        self.detections += 1
+        unmatched = set(self.tracks)
+        for detection in sorted(detections, key=lambda d: -d.confidence):
+            best, best_iou = None, self.iou_threshold
+            for track_id in unmatched:
+                tracked = self.tracks[track_id][0]
+                overlap = iou(tracked.box, detection.box)
+                if tracked.class_id == detection.class_id and overlap >= best_iou:
+                    best, best_iou = track_id, overlap
+            if best is None:
+                best = self._next_id
+                self._next_id += 1
+            else:
+                unmatched.discard(best)
+            self.tracks[best] = [detection._replace(track_id=best),
+                                 self.features(gray, detection.box), 0]
+
+        for track_id in unmatched:
+            self.tracks[track_id][2] += 1
+            if self.tracks[track_id][2] > self.max_misses:
+                del self.tracks[track_id]
+
+    def propagate(self, gray):
+        """
+        Moves the boxes along with their points; False if there were boxes
+        but none of them could be tracked
+        """
+        tracked = failed = 0
+        for track in self.tracks.values():
+            detection, points, misses = track
+            if misses:
+                continue
+            if points is None or len(points) < self.min_points:
+                # Small or featureless box: freeze it
+                failed += 1
+                continue
+            new_points, status, _ = cv2.calcOpticalFlowPyrLK(
+                self.prev_gray, gray, points, None)
+            found = status.flatten() == 1
+            if found.sum() < self.min_points:
+                # Lost the flow: freeze the box and don't try it again
+                track[1] = None
+                failed += 1
+                continue
+            tracked += 1
+            dx, dy = np.median((new_points - points)[found].reshape(-1, 2), axis=0)
+            x, y, w, h = detection.box
+            track[0] = detection._replace(box=[int(x + dx), int(y + dy), w, h])
+            track[1] = new_points[found].reshape(-1, 1, 2)
+        self.frozen += failed
+        return tracked > 0 or failed == 0
+
+    def stats(self):
+        return {
+            'tracks': sum(1 for track in self.tracks.values() if track[2] == 0),
+            'track_frames': self.frames,
+            'track_detections': self.detections,
+            'track_failures': self.failures,
+            'track_frozen': self.frozen,
+        }
+
+
+class BatchedInference:
+    """
+    Shares one ObjectDetection between several cameras. Calls to infer from
+    the camera threads are collected for up to max_wait seconds (or until
+    every camera is waiting) and answered with a single batched forward
+    pass. Everything else is passed on to the wrapped model.
+    """
+
+    def __init__(self, model, batch_size, max_wait=0.02):
+        self.model = model
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.frames = 0
+
+        self._pending = [] # (snap, threshold, future)
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self.infer_forever, daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def infer(self, snap, threshold=0.5):
+        future = Future()
+        with self._cond:
+            self._pending.append((snap, threshold, future))
+            self._cond.notify()
+        return future.result()
+
+    def infer_forever(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                deadline = time.time() + self.max_wait
+                while len(self._pending) < self.batch_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                pending, self._pending = self._pending, []
+
+            # Frames with the same threshold share a forward pass
+            thresholds = {}
+            for request in pending:
+                thresholds.setdefault(request[1], []).append(request)
+            for threshold, batch in thresholds.items():
+                try:
+                    results = self.model.infer_batch(
+                        [snap for snap, _, _ in batch], threshold)
+                    for (_, _, future), detections in zip(batch, results):
+                        future.set_result(detections)
+                except Exception as e:
+                    for _, _, future in batch:
+                        future.set_exception(e)
+                self.batches += 1
+                self.frames += len(batch)
+
+    def detect(self, snap, threshold=0.5, camera=None):
+        detections = self.infer(snap, threshold)
+        self.report(detections, camera)
+        return detections
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'batch_size': round(self.frames / max(1, self.batches), 2),
+        }
+
+
+class DetectionWorker:
+    """
+    Runs detection in a background thread on the newest submitted frame,
+    dropping frames that arrive while it is busy. The latest detections can
+    be drawn on top of every streamed frame.
+    """
+
+    def __init__(self, detect, max_fps=None):
+        self.detect = detect
+        self.max_fps = max_fps
+        self.detections = []
+        self.fps = 0.0
+        self.processed = 0
+        self.dropped = 0
+
+        self._frame = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self.detect_forever, daemon=True)
+        self._thread.start()
+
+    def submit(self, frame):
+        with self._cond:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self._cond.notify()
+
+    def detect_forever(self):
+        last = None
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._frame is not None)
+                frame, self._frame = self._frame, None
+
+            start = time.time()
+            try:
+                self.detections = self.detect(frame)
+            except Exception as e:
+                log.error(e)
+            self.processed += 1
+
+            if self.max_fps:
+                time.sleep(max(0, 1 / self.max_fps - (time.time() - start)))
+            now = time.time()
+            if last is not None:
+                # Smoothed rate of finished detections
+                self.fps = 0.9 * self.fps + 0.1 / max(now - last, 1e-6)
+            last = now
+
+    def stats(self):
+        return {
+            'detect_fps': round(self.fps, 2),
+            'processed': self.processed,
+            'dropped': self.dropped,
+        }
+
+
+class FrameClock:
+    """Paces a loop to fps ticks per second, without drifting"""
+
+    def __init__(self, fps):
+        self.fps = fps
+        self._next = time.perf_counter()
+
+    def tick(self):
+        if not self.fps:
+            return
+        self._next += 1 / self.fps
+        delay = self._next - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Running behind, don't try to catch up with a burst of frames
+            self._next = time.perf_counter()
+
+
+class FileCapture:
+    """
+    Stands in for cv2.VideoCapture with a video file or a directory of
+    images, played back at real-time speed (the video's own frame rate, or
+    fps for images) or as fast as possible.
+    """
+
+    IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+    def __init__(self, path, realtime=True, fps=10, loop=False):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.files = None
+        if os.path.isdir(path):
+            self.files = sorted(
+                os.path.join(path, f) for f in os.listdir(path)
+                if f.lower().endswith(self.IMAGE_EXTENSIONS))
+            self.fps = fps
+            first = cv2.imread(self.files[0]) if self.files else None
+            self.size = first.shape[:2] if first is not None else (0, 0)
+        else:
+            self.video = cv2.VideoCapture(path)
+            self.fps = self.video.get(cv2.CAP_PROP_FPS) or fps
+            self.size = (int(self.video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                         int(self.video.get(cv2.CAP_PROP_FRAME_WIDTH)))
+        self.position = 0
+        self.clock = FrameClock(self.fps if realtime else None)
+        self._opened = bool(self.files) if self.files is not None else self.video.isOpened()
+
+    def isOpened(self):
+        return self._opened
+
+    def read(self):
+        self.clock.tick()
+        if self.files is not None:
+            if self.position >= len(self.files) and self.loop:
+                self.position = 0
+            if self.position >= len(self.files):
+                return False, None
+            frame = cv2.imread(self.files[self.position])
+            ret = frame is not None
+        else:
+            ret, frame = self.video.read()
+            if not ret and self.loop:
+                self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                ret, frame = self.video.read()
+        self.position += 1
+        return ret, frame
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.size[0]
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.size[1]
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        return 0.0
+
+    def set(self, prop, value):
+        return False
+
+    def release(self):
+        if self.files is None:
+            self.video.release()
+        self._opened = False
+
 
 class VideoStreaming(object):
-    def __init__(self, object_detection_model, cam_index=0, preview=True):
+    def __init__(self, object_detection_model, cam_index=0, preview=True,
+                 detect_threshold=0.01, detect_async=False, detect_fps=None,
+                 motion_gate=None, tracker=None, name=None,
+                 fps=30, jpeg_quality=80, scale=0.5, resolution=None, realtime=True):
         super(VideoStreaming, self).__init__()
-        self.VIDEO = cv2.VideoCapture(cam_index)
-
+        if isinstance(cam_index, str):
+            # Replay a video file or image directory instead of a camera
+            self.VIDEO = FileCapture(cam_index, realtime=realtime)
+            # The replay paces itself (at the video's own frame rate, if at all)
+            fps = None
+        else:
+            self.VIDEO = cv2.VideoCapture(cam_index)
+        if cam_index == 0:
+            # Restore the stored settings of the default camera
+            check_settings(self.VIDEO)
+
+        # An ObjectDetection, or a BatchedInference shared with other cameras
         self.MODEL = object_detection_model
+        self.detect_threshold = detect_threshold
+        # Tag for the SEE inputs of this camera, when there are several
+        self.name = name
+
+        # Optional MotionGate: skip inference and reuse the last detections
+        # while the scene does not change
+        self.gate = motion_gate
+        self.last_detections = []
+
+        # Optional Tracker: only run full detection every few frames and
+        # follow the boxes in between
+        self.tracker = tracker
+
+        # In async mode, detection runs at its own rate (at most detect_fps)
+        # and the stream draws the latest detections on every frame
+        self.worker = None
+        if detect_async:
+            self.worker = DetectionWorker(self.detect_frame, max_fps=detect_fps)
 
         self._preview = preview
         self._flipH = False
@@ -162,6 +831,18 @@ class VideoStreaming(object):
         self._initial_contrast = self.VIDEO.get(cv2.CAP_PROP_CONTRAST)
         self._contrast = self._initial_contrast
 
+        # Stream settings; resolution (width, height) overrides scale
+        self.fps = fps
+        self.jpeg_quality = jpeg_quality
+        self.scale = scale
+        self.resolution = resolution
+        self._placeholders = {}
+        self._idle_frame = None
+
+        self.frames = Broadcast()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
     @staticmethod
     def rescale_frame(frame, scale):
         width = int(frame.shape[1] * scale)
@@ -211,43 +892,128 @@ class VideoStreaming(object):
         self._contrast = self._initial_contrast + float(value)
         self.VIDEO.set(cv2.CAP_PROP_CONTRAST, self._contrast)
 
-    def show(self):
+    def infer_frame(self, snap):
+        if not self.MODEL.loaded.is_set():
+            # Leave the gate alone, or a static scene would never count as
+            # changed once the model is there
+            return []
+        if self.gate and not self.gate.changed(snap):
+            return self.last_detections
+        self.last_detections = self.MODEL.infer(snap, threshold=self.detect_threshold)
+        return self.last_detections
+
+    def detect_frame(self, snap):
+        if self.tracker:
+            detections = self.tracker.update(snap, self.infer_frame)
+        else:
+            detections = self.infer_frame(snap)
+        # Also for reused detections, to keep the last seen times up to date
+        self.MODEL.report(detections, self.name)
+        return detections
+
+    def stats(self):
+        stats = {'detect': self.detect, 'async': bool(self.worker)}
+        if self.worker:
+            stats.update(self.worker.stats())
+        if self.gate:
+            stats.update(self.gate.stats())
+        if self.tracker:
+            stats.update(self.tracker.stats())
+        return stats
+
+    def start(self):
+        """
+        Starts the shared capture thread (once). It reads, processes and
+        encodes every frame a single time and publishes the JPEG to all
+        /video_feed clients.
+        """
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.capture_forever,
+                                                daemon=True)
+                self._thread.start()
+
+    def resize(self, frame):
+        if self.resolution:
+            return cv2.resize(frame, tuple(self.resolution), interpolation=cv2.INTER_AREA)
+        if self.scale != 1:
+            return self.rescale_frame(frame, self.scale)
+        return frame
+
+    def encode(self, snap):
+        frame = cv2.imencode(
+            ".jpg", snap, [cv2.IMWRITE_JPEG_QUALITY, int(self.jpeg_quality)])[1].tobytes()
+        return b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n"
+
+    def placeholder(self, width, height):
+        """The 'camera disabled' frame, encoded once per size and quality"""
+        key = (width, height, self.jpeg_quality)
+        if key not in self._placeholders:
+            snap = np.zeros((height, width), np.uint8)
+            label = "camera disabled"
+            color = (255, 255, 255)
+            cv2.putText(snap, label, (width // 2 - 100, height // 2), FONT, 2, color, 2)
+            self._placeholders[key] = self.encode(snap)
+        return self._placeholders[key]
+
+    def capture_forever(self):
+        try:
+            self.capture_frames()
+        finally:
+            # Ends the streams of the clients, also when capturing failed
+            self.frames.close()
+            log.info('Video capture stopped')
+
+    def capture_frames(self):
+        if self.detect and isinstance(self.VIDEO, FileCapture):
+            # A replay has no frames to spare, so don't read any until the
+            # model can detect in them
+            self.MODEL.loaded.wait()
+        clock = FrameClock(self.fps)
         while self.VIDEO.isOpened():
+            clock.fps = self.fps
+            if not self._preview:
+                # Publish the cached placeholder once and leave the camera be,
+                # so a disabled preview costs next to nothing
+                if self.frames.latest()[1] is not self._idle_frame:
+                    width = int(self.VIDEO.get(cv2.CAP_PROP_FRAME_WIDTH))
+                    height = int(self.VIDEO.get(cv2.CAP_PROP_FRAME_HEIGHT))
+                    if self.resolution:
+                        width, height = self.resolution
+                    else:
+                        width, height = int(width * self.scale), int(height * self.scale)
+                    self._idle_frame = self.placeholder(width, height)
+                    self.frames.publish(self._idle_frame)
+                time.sleep(0.1)
+                continue
+
             ret, snap = self.VIDEO.read()
+            if not ret:
+                break
 
-            snap = self.rescale_frame(snap, 0.5)
+            snap = self.resize(snap)
 
             if self.flipH:
                 snap = cv2.flip(snap, 1)
 
-            if ret == True:
-                if self._preview:
-                    # snap = cv2.resize(snap, (0, 0), fx=0.5, fy=0.5)
-                    if self.detect:
-                        snap = self.MODEL.detectObj(snap, threshold=0.01)
-
+            if self.detect:
+                if self.worker:
+                    self.worker.submit(snap.copy())
+                    detections = self.worker.detections
                 else:
-                    snap = np.zeros(
-                        (
-                            int(self.VIDEO.get(cv2.CAP_PROP_FRAME_HEIGHT)),
-                            int(self.VIDEO.get(cv2.CAP_PROP_FRAME_WIDTH)),
-                        ),
-                        np.uint8,
-                    )
-                    label = "camera disabled"
-                    H, W = snap.shape
-                    color = (255, 255, 255)
-                    cv2.putText(snap, label, (W // 2 - 100, H // 2), FONT, 2, color, 2)
-                
-                color = (255, 255, 255)
-                time_str = f'{datetime.now():%H:%M:%S}'
-                cv2.putText(snap, time_str, (2,22), FONT, 2, color, 2)
-
-                frame = cv2.imencode(".jpg", snap)[1].tobytes()
-                yield (
-                    b"--frame\r\n" b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n"
-                )
-                time.sleep(0.01)
+                    detections = self.detect_frame(snap)
+                snap = self.MODEL.draw(snap, detections)
 
-            else:
-                break
+            color = (255, 255, 255)
+            time_str = f'{datetime.now():%H:%M:%S}'
+            cv2.putText(snap, time_str, (2,22), FONT, 2, color, 2)
+
+            self.frames.publish(self.encode(snap))
+            clock.tick()
+
+    def show(self):
+        self.start()
+        # Each client only reads the shared slot, so a slow client skips frames
+        # instead of holding up the capture thread. A still frame (e.g. the
+        # placeholder while the preview is off) is resent every second.
+        yield from self.frames.subscribe(timeout=1, resend=1)